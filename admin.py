@@ -0,0 +1,127 @@
+import asyncio
+import functools
+import logging
+import os
+import tempfile
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from dead_letters import dead_letters
+from export import export_profiles, writers
+from funnel import funnel
+from memory_report import memory_report, FRAMES, MAX_REPLY
+from outbox import outbox
+from qr_codes import DEEP_LINK_PAYLOAD, campaigns, deep_link, qr_cache
+from storage import sessions
+
+logger = logging.getLogger(__name__)
+
+
+def admin_ids() -> set:
+    return {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(' ', '').split(',') if user_id}
+
+
+def admin_only(callback):
+    """Пропускает команду только от пользователей из ADMIN_IDS, остальным бот молча не отвечает."""
+
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: CallbackContext):
+        user = update.effective_user
+        if user is None or user.id not in admin_ids():
+            logger.warning("Rejected admin command from user %s", user.id if user else None)
+            return None
+        return await callback(update, context)
+
+    return wrapper
+
+
+@admin_only
+async def broadcast_command(update: Update, context: CallbackContext) -> None:
+    """/broadcast <id> <текст> запускает рассылку, /broadcast <id> продолжает начатую."""
+    broadcast = context.application.bot_data['broadcast']
+    if not context.args:
+        await update.message.reply_text("Использование: /broadcast <id> <текст рассылки>")
+        return
+    if broadcast.running:
+        await update.message.reply_text("Рассылка уже идет.\n\n" + broadcast.status())
+        return
+
+    campaign_id = context.args[0]
+    text = update.message.text_html.split(maxsplit=2)[2] if len(context.args) > 1 else None
+    broadcast.start(campaign_id, text)
+    await update.message.reply_text(f"Рассылка {campaign_id} запущена. Статус: /broadcast_status")
+
+
+@admin_only
+async def broadcast_status_command(update: Update, context: CallbackContext) -> None:
+    await update.message.reply_text(context.application.bot_data['broadcast'].status())
+
+
+@admin_only
+async def export_command(update: Update, context: CallbackContext) -> None:
+    """/export [csv|jsonl] [new] присылает файл с анкетами; с new - только изменившиеся с прошлого /export new."""
+    fmt = context.args[0] if context.args else 'csv'
+    if fmt not in writers:
+        await update.message.reply_text("Использование: /export [csv|jsonl] [new]")
+        return
+    incremental = 'new' in context.args[1:]
+
+    await sessions.flush()
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}')
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(export_profiles, sessions.backend, path, fmt, incremental, True, 'admin')
+        with open(path, 'rb') as file:
+            await update.message.reply_document(file, filename=f"profiles.{fmt}", caption=f"Записей: {count}")
+    finally:
+        os.remove(path)
+
+
+@admin_only
+async def qr_command(update: Update, context: CallbackContext) -> None:
+    """/qr <код> присылает QR-код deep-link на бота с этим кодом."""
+    code = context.args[0] if context.args else ''
+    if not DEEP_LINK_PAYLOAD.match(code):
+        await update.message.reply_text("Использование: /qr <код кампании>")
+        return
+    png = await qr_cache.fetch(code, context.bot.username)
+    category = campaigns.get(code, "неизвестная кампания")
+    await update.message.reply_photo(png, caption=f"{deep_link(code, context.bot.username)}\n{category}")
+
+
+@admin_only
+async def dead_letters_command(update: Update, context: CallbackContext) -> None:
+    """/dead_letters показывает недоставленные сообщения, /dead_letters replay отправляет их заново."""
+    if context.args[:1] == ['replay']:
+        count = dead_letters.replay(outbox)
+        await update.message.reply_text(f"Повторно поставлено в очередь: {count}")
+        return
+    await update.message.reply_text(dead_letters.summary())
+
+
+@admin_only
+async def funnel_command(update: Update, context: CallbackContext) -> None:
+    """/funnel [часы] [площадка или категория] — переходы по состояниям анкеты, по умолчанию за 24 часа."""
+    args = list(context.args)
+    hours = int(args.pop(0)) if args and args[0].isdigit() else 24
+    segment = ' '.join(args) or None
+    await update.message.reply_text(await funnel.report(hours, segment))
+
+
+@admin_only
+async def memory_command(update: Update, context: CallbackContext) -> None:
+    """/memory — размеры структур; /memory trace [кадры], /memory snapshot, /memory stop — tracemalloc."""
+    action = context.args[0] if context.args else None
+    if action == 'trace':
+        frames = int(context.args[1]) if len(context.args) > 1 and context.args[1].isdigit() else FRAMES
+        memory_report.start_tracing(frames)
+        text = "tracemalloc включен. Снимок: /memory snapshot"
+    elif action == 'snapshot':
+        text = await memory_report.snapshot()
+    elif action == 'stop':
+        await memory_report.stop_tracing()
+        text = "tracemalloc выключен."
+    else:
+        text = await memory_report.report(context.application)
+    await update.message.reply_text(text[:MAX_REPLY])
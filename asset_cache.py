@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+
+from sizing import estimate
+
+logger = logging.getLogger(__name__)
+
+ASSET_CACHE_FILE = 'asset_cache.json'
+
+
+class AssetCache:
+    """Запоминает file_id, выданные Telegram для статических файлов, чтобы не загружать их повторно."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = {}
+        self._digests = {}
+        self._load()
+
+    def configure(self, path: str):
+        self.path = path
+        self._entries = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                self._entries = json.load(file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Could not load asset cache %s: %s", self.path, e)
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp{os.getpid()}"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(self._entries, file, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("Could not save asset cache %s: %s", self.path, e)
+
+    def _digest(self, asset_path: str) -> str:
+        # Хеш пересчитывается только при изменении размера или времени модификации файла
+        stat = os.stat(asset_path)
+        cached = self._digests.get(asset_path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+        sha256 = hashlib.sha256()
+        with open(asset_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(65536), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        self._digests[asset_path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def memory_usage(self) -> list:
+        return [('asset_cache', len(self._entries), estimate(self._entries) + estimate(self._digests))]
+
+    def get_file_id(self, asset_path: str):
+        entry = self._entries.get(asset_path)
+        if entry is None:
+            return None
+        if entry['sha256'] != self._digest(asset_path):
+            logger.info("Asset %s changed, dropping cached file_id", asset_path)
+            self.forget(asset_path)
+            return None
+        return entry['file_id']
+
+    def remember(self, asset_path: str, file_id: str):
+        if not file_id:
+            return
+        digest = self._digest(asset_path)
+        entry = self._entries.get(asset_path)
+        if entry and entry['file_id'] == file_id and entry['sha256'] == digest:
+            return
+        self._entries[asset_path] = {'sha256': digest, 'file_id': file_id}
+        self._save()
+
+    def forget(self, asset_path: str):
+        """Забывает file_id, который Telegram отклонил (BadRequest); после сетевых ошибок он еще годен."""
+        if self._entries.pop(asset_path, None) is not None:
+            self._save()
+
+    @contextmanager
+    def input_file(self, asset_path: str):
+        """Возвращает file_id, если файл уже загружался, иначе открытый файл."""
+        file_id = self.get_file_id(asset_path)
+        if file_id:
+            yield file_id
+            return
+        with open(asset_path, 'rb') as file:
+            yield file
+
+
+def sent_file_id(message) -> str:
+    """Достает file_id из отправленного сообщения с фото или документом."""
+    if message.photo:
+        return message.photo[-1].file_id
+    if message.document:
+        return message.document.file_id
+    return None
+
+
+asset_cache = AssetCache(ASSET_CACHE_FILE)
@@ -0,0 +1,183 @@
+"""Микробенчмарк обработчиков: процессорное время и выделенная память на один апдейт.
+
+    python bench.py                   # сравнить с bench_baseline.json, код возврата 1 при регрессии
+    python bench.py --save            # записать результат как новый baseline
+    python bench.py --users 500 --threshold 0.3
+
+Бот работает без сети: на вызовы Bot API отвечает OfflineRequest из fake_bot_api. Апдейты — шаги
+анкеты из load_test.py и нажатия кнопок меню, каждый виртуальный пользователь проходит их по
+порядку. Время шага — медиана по пользователям, вместе с отправкой всего, что шаг поставил
+в outbox. Память меряется отдельным проходом под tracemalloc, потому что он сам замедляет код
+в несколько раз: пик выделенного во время апдейта и то, что осталось после него.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fake_bot_api import OfflineRequest
+from load_test import MENU_TAPS, menu_script, user_funnel
+
+BASELINE_FILE = 'bench_baseline.json'
+# Регрессия засчитывается, если шаг стал медленнее или прожорливее baseline больше чем на эту долю
+THRESHOLD = 0.2
+FIRST_USER_ID = 2 * 10 ** 9
+
+
+def user_script(index: int) -> list:
+    """Шаги пользователя: (название шага, апдейт). Повторное нажатие той же кнопки меню — отдельный шаг."""
+    user_id = FIRST_USER_ID + index
+    script = user_funnel(user_id, index)
+    menu = menu_script(user_id, script[-1][1], len(MENU_TAPS))
+    for i, (_, update) in enumerate(menu):
+        data = MENU_TAPS[i]
+        repeated = i and MENU_TAPS[i - 1] == data
+        script.append((f"MENU {data}" + (" again" if repeated else ""), update))
+    return script
+
+
+async def measure(users: int, alloc_users: int) -> dict:
+    from telegram import Update
+    from main import build_application, configure_services, on_startup, on_stop, on_shutdown
+    from outbox import outbox
+
+    cpu = {}
+    peak = {}
+    retained = {}
+    request = OfflineRequest()
+    configure_services()
+    application = build_application("123456:BENCH", request=request)
+
+    async def feed(index: int, traced: bool):
+        for step, data in user_script(index):
+            update = Update.de_json(data, application.bot)
+            if traced:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+            started = time.process_time_ns()
+            await application.process_update(update)
+            await outbox.join()
+            elapsed = time.process_time_ns() - started
+            if traced:
+                current, top = tracemalloc.get_traced_memory()
+                peak.setdefault(step, []).append(top - before)
+                retained.setdefault(step, []).append(current - before)
+            else:
+                cpu.setdefault(step, []).append(elapsed)
+
+    async with application:
+        await on_startup(application)
+        # Первый пользователь прогревает кеши файлов, шаблонов и импортов и в замеры не входит
+        await feed(users + alloc_users, traced=False)
+        cpu.clear()
+        for index in range(users):
+            await feed(index, traced=False)
+        tracemalloc.start()
+        try:
+            for index in range(users, users + alloc_users):
+                await feed(index, traced=True)
+        finally:
+            tracemalloc.stop()
+        await on_stop(application)
+        await on_shutdown(application)
+
+    return {
+        "python": platform.python_version(),
+        "users": users,
+        "api_calls": dict(request.calls),
+        "steps": {
+            step: {
+                "cpu_us": round(statistics.median(cpu[step]) / 1000, 1),
+                "alloc_peak_bytes": int(statistics.median(peak[step])),
+                "retained_bytes": int(statistics.median(retained[step])),
+            }
+            for step in cpu
+        },
+    }
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> list:
+    """Шаги, которые хуже baseline больше чем на threshold: (шаг, метрика, было, стало)."""
+    regressions = []
+    for step, row in result["steps"].items():
+        base = baseline["steps"].get(step)
+        if base is None:
+            continue
+        for metric in ("cpu_us", "alloc_peak_bytes"):
+            if row[metric] > base[metric] * (1 + threshold):
+                regressions.append((step, metric, base[metric], row[metric]))
+    return regressions
+
+
+def print_result(result: dict, baseline: dict = None):
+    print(f"{'step':<32}{'cpu us':>10}{'peak B':>10}{'kept B':>10}{'cpu Δ':>9}{'peak Δ':>9}")
+    for step, row in result["steps"].items():
+        base = (baseline or {}).get("steps", {}).get(step)
+        deltas = ""
+        if base:
+            deltas = "".join(
+                f"{(row[metric] / base[metric] - 1) * 100:>+8.0f}%" if base[metric] else f"{'-':>9}"
+                for metric in ("cpu_us", "alloc_peak_bytes")
+            )
+        print(f"{step:<32}{row['cpu_us']:>10}{row['alloc_peak_bytes']:>10}{row['retained_bytes']:>10}{deltas}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark handler CPU time and allocations per update")
+    parser.add_argument("--users", type=int, default=200, help="virtual users for the CPU pass")
+    parser.add_argument("--alloc-users", type=int, default=30, help="virtual users for the tracemalloc pass")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true", help="write the result as the new baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="allowed slowdown, 0.2 = 20%%")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    os.environ.update({
+        "SESSION_BACKEND": "memory",
+        "ASSET_CACHE_FILE": os.path.join(workdir, "asset_cache.json"),
+        "DEAD_LETTER_FILE": os.path.join(workdir, "dead_letters.jsonl"),
+        "MESSAGE_PACE": "0",
+        "OUTBOX_GLOBAL_RATE": "1000000",
+        "OUTBOX_CHAT_RATE": "1000000",
+        "OUTBOX_CHAT_BURST": "1000000",
+        "METRICS_PORT": "0",
+    })
+    result = asyncio.run(measure(args.users, args.alloc_users))
+
+    baseline = None
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=1))
+    else:
+        print_result(result, baseline)
+
+    if args.save:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=1)
+        print(f"Baseline saved to {args.baseline}")
+        return
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --save to create one")
+        return
+
+    regressions = compare(result, baseline, args.threshold)
+    for step, metric, before, after in regressions:
+        print(f"REGRESSION {step} {metric}: {before} -> {after}")
+    print(f"{'FAIL' if regressions else 'PASS'}: threshold {args.threshold:.0%}, {len(regressions)} regressions")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+from outbox import outbox, TokenBucket
+from retry import retry_after_seconds
+from storage import sessions
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_KEY = 'broadcast:active'
+PROGRESS_LOG_INTERVAL = 10.0
+
+
+def campaign_key(campaign_id: str) -> str:
+    return f'broadcast:{campaign_id}'
+
+
+def _log_failure(task):
+    if not task.cancelled() and task.exception():
+        logger.error("Broadcast failed: %s", task.exception())
+
+
+class Broadcast:
+    """Рассылка по всем активным пользователям с контрольными точками.
+
+    Получатели перебираются по возрастанию user_id, и перед каждой отправкой сохраняется текущий
+    user_id, поэтому после падения рассылка продолжается без повторов. Частота отправки
+    ограничена своим token bucket и уменьшается вдвое на каждый 429; токены общего ведра outbox
+    берутся только сверх резерва, оставленного для интерактивных сообщений. Из того же ведра
+    берут токены и ответы обработчиков, отправленные напрямую, — это делает RetryLimiter.
+    """
+
+    def __init__(self, bot, rate: float = 20, reserve: float = 10, min_rate: float = 1):
+        self.bot = bot
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.reserve = reserve
+        self.state = None
+        self._bucket = TokenBucket(rate, 1)
+        self._started = None
+        self._last_report = 0.0
+        self.task = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self, campaign_id: str, text: str = None):
+        # Задача не отдается Application.create_task: иначе остановка бота ждала бы конца рассылки
+        self.task = asyncio.create_task(self.run(campaign_id, text))
+        self.task.add_done_callback(_log_failure)
+        return self.task
+
+    async def stop(self):
+        if self.running:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    @property
+    def rate(self) -> float:
+        return self._bucket.rate
+
+    def _slow_down(self):
+        self._bucket.rate = max(self.min_rate, self._bucket.rate / 2)
+
+    def _speed_up(self):
+        self._bucket.rate = min(self.max_rate, self._bucket.rate + 0.1)
+
+    async def run(self, campaign_id: str, text: str = None):
+        state = await sessions.get_meta(campaign_key(campaign_id))
+        if state is None:
+            if text is None:
+                raise ValueError(f"Unknown broadcast campaign: {campaign_id}")
+            state = {'campaign': campaign_id, 'text': text, 'last_user_id': 0,
+                     'sent': 0, 'blocked': 0, 'failed': 0, 'done': False}
+        if state['done']:
+            logger.info("Broadcast %s is already finished", campaign_id)
+            self.state = state
+            return state
+
+        self.state = state
+        await sessions.put_meta(ACTIVE_KEY, campaign_id)
+        await sessions.put_meta(campaign_key(campaign_id), state)
+        self._started = time.monotonic()
+        sent_at_start = state['sent']
+        logger.info("Broadcast %s started after user %s", campaign_id, state['last_user_id'])
+
+        async for user_id in sessions.iter_user_ids(after=state['last_user_id']):
+            # Контрольная точка пишется до отправки: после падения пользователь будет пропущен, но не получит дубль
+            state['last_user_id'] = user_id
+            await sessions.put_meta(campaign_key(campaign_id), state)
+            await self._send(user_id, state)
+            self._report(state, sent_at_start)
+
+        state['done'] = True
+        await sessions.put_meta(campaign_key(campaign_id), state)
+        await sessions.put_meta(ACTIVE_KEY, None)
+        logger.info(
+            "Broadcast %s finished: %s sent, %s blocked, %s failed",
+            campaign_id, state['sent'], state['blocked'], state['failed']
+        )
+        return state
+
+    async def _send(self, user_id: int, state: dict):
+        while True:
+            await self._bucket.acquire()
+            bucket = outbox.global_bucket
+            await bucket.acquire(reserve=min(self.reserve, bucket.capacity - 1))
+            try:
+                # Повторы RetryLimiter отключены: на 429 рассылка сама снижает скорость
+                await self.bot.send_message(
+                    chat_id=user_id, text=state['text'], parse_mode='HTML',
+                    rate_limit_args={'max_retries': 0, 'metered': True}
+                )
+            except RetryAfter as e:
+                self._slow_down()
+                retry_after = retry_after_seconds(e)
+                logger.warning("Broadcast hit flood control, sleeping %s s, rate %.1f/s", retry_after, self.rate)
+                await asyncio.sleep(retry_after)
+                continue
+            except Forbidden:
+                # Пользователь может принадлежать другому процессу, поэтому флаг пишется прямо в хранилище
+                await sessions.deactivate(user_id)
+                state['blocked'] += 1
+            except TelegramError as e:
+                logger.warning("Broadcast to user %s failed: %s", user_id, e)
+                state['failed'] += 1
+            else:
+                state['sent'] += 1
+                self._speed_up()
+            return
+
+    def _report(self, state: dict, sent_at_start: int):
+        now = time.monotonic()
+        if now - self._last_report < PROGRESS_LOG_INTERVAL:
+            return
+        self._last_report = now
+        elapsed = now - self._started
+        logger.info(
+            "Broadcast %s: %s sent, %s blocked, %s failed, %.1f msg/s",
+            state['campaign'], state['sent'], state['blocked'], state['failed'],
+            (state['sent'] - sent_at_start) / elapsed if elapsed else 0.0
+        )
+
+    def status(self) -> str:
+        if self.state is None:
+            return "Рассылка не запускалась."
+        state = self.state
+        elapsed = time.monotonic() - self._started if self._started else 0
+        return (
+            f"Рассылка {state['campaign']}: {'завершена' if state['done'] else 'идет'}\n"
+            f"Отправлено: {state['sent']}, заблокировали бота: {state['blocked']}, ошибок: {state['failed']}\n"
+            f"Последний user_id: {state['last_user_id']}, скорость: {self.rate:.1f}/с, время: {elapsed:.0f} с"
+        )
+
+
+async def resume_active_broadcast(broadcast: Broadcast):
+    """Продолжает рассылку, прерванную остановкой или падением бота."""
+    campaign_id = await sessions.get_meta(ACTIVE_KEY)
+    if campaign_id:
+        logger.info("Resuming broadcast %s", campaign_id)
+        broadcast.start(campaign_id)
@@ -157,6 +157,21 @@ photo_paths = {
 
 CONNECT, NAME_REQUEST, CONSENT, PLATFORM, ORDER_NUMBER, CONTACT, EMAIL, BIRTHDAY, FINAL, MAIN_MENU, PERSONAL_CABINET, ORDER_NUMBER_PROMPT = range(12)
 
+state_names = {
+    CONNECT: 'CONNECT',
+    NAME_REQUEST: 'NAME_REQUEST',
+    CONSENT: 'CONSENT',
+    PLATFORM: 'PLATFORM',
+    ORDER_NUMBER: 'ORDER_NUMBER',
+    CONTACT: 'CONTACT',
+    EMAIL: 'EMAIL',
+    BIRTHDAY: 'BIRTHDAY',
+    FINAL: 'FINAL',
+    MAIN_MENU: 'MAIN_MENU',
+    PERSONAL_CABINET: 'PERSONAL_CABINET',
+    ORDER_NUMBER_PROMPT: 'ORDER_NUMBER_PROMPT'
+}
+
 
 category_cases = {
     'Постельное белье': 'постельном белье',
@@ -183,5 +198,3 @@ backup={
         'С заботой о Вашем комфорте, команда MirrorSleep.'
     )
 }
-
-user_data = {}
\ No newline at end of file
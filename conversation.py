@@ -0,0 +1,148 @@
+"""Описание диалога анкеты.
+
+    python conversation.py      # проверить описание: недостижимые состояния и мертвые кнопки
+"""
+import sys
+
+from flow import Flow, Step
+from handlers import (
+    start, request_name, send_intro_message, handle_consent, handle_platform_choice, switch_to_order_number,
+    show_platforms, show_main_menu, show_personal_cabinet, open_main_menu, open_personal_cabinet, show_test_info,
+    confirm_data, reject_data, change_name, change_category, change_platform,
+    change_order_number, change_contact, change_email, change_birthday, unknown_data_change,
+    request_contact, request_email, request_birthday, handle_birthday
+)
+from keyboards import (
+    MAIN_MENU_KEYBOARD, PLATFORM_KEYBOARD, CHANGE_DATA_KEYBOARD, SWITCH_TO_ORDER_KEYBOARD, CONFIRMATION_KEYBOARD,
+    PERSONAL_CABINET_KEYBOARD, ACCEPT_KEYBOARD
+)
+from orders import is_valid_order_number, normalize_order_number, order_number_hint
+from utils import is_cyrillic, is_valid_birthday, is_valid_email
+from config import (
+    CONNECT, NAME_REQUEST, CONSENT, PLATFORM, ORDER_NUMBER, CONTACT, EMAIL, BIRTHDAY, FINAL, MAIN_MENU,
+    PERSONAL_CABINET, ORDER_NUMBER_PROMPT, platforms, state_names
+)
+
+DATA_CHANGES = {
+    'change_name': ("Имя", change_name),
+    'change_category': ("Категория", change_category),
+    'change_platform': ("Площадка", change_platform),
+    'change_order_number': ("Номер заказа", change_order_number),
+    'change_contact': ("Контакт", change_contact),
+    'change_email': ("Email", change_email),
+    'change_birthday': ("Дата рождения", change_birthday),
+}
+
+START = Step(
+    'START',
+    commands={'start': start},
+    next=(CONNECT, MAIN_MENU, NAME_REQUEST, CONSENT, PLATFORM, ORDER_NUMBER_PROMPT, ORDER_NUMBER, CONTACT, EMAIL, BIRTHDAY)
+)
+
+FLOW = Flow(
+    entry=START,
+    steps=[
+        Step(
+            CONNECT,
+            text=send_intro_message,
+            next=(NAME_REQUEST, CONSENT)
+        ),
+        Step(
+            NAME_REQUEST,
+            text=request_name,
+            validator=lambda text, user_info: is_cyrillic(text),
+            retry="Пожалуйста, введите свое имя на русском языке.",
+            next=(CONSENT,)
+        ),
+        Step(
+            CONSENT,
+            callbacks={'accept': handle_consent},
+            keyboards=(ACCEPT_KEYBOARD,),
+            next=(PLATFORM,)
+        ),
+        Step(
+            PLATFORM,
+            callbacks={platform['callback_data']: handle_platform_choice for platform in platforms},
+            keyboards=(PLATFORM_KEYBOARD,),
+            next=(ORDER_NUMBER_PROMPT,)
+        ),
+        Step(
+            ORDER_NUMBER_PROMPT,
+            callbacks={'switch_state_to_order': switch_to_order_number, 'choose_platform': show_platforms},
+            keyboards=(SWITCH_TO_ORDER_KEYBOARD,),
+            next=(ORDER_NUMBER, PLATFORM)
+        ),
+        Step(
+            ORDER_NUMBER,
+            text=request_contact,
+            validator=lambda text, user_info: is_valid_order_number(user_info.get('platform'), normalize_order_number(text)),
+            retry=lambda user_info: order_number_hint(user_info.get('platform')),
+            next=(CONTACT,)
+        ),
+        Step(
+            CONTACT,
+            contact=request_email,
+            text=request_email,
+            next=(EMAIL,)
+        ),
+        Step(
+            EMAIL,
+            text=request_birthday,
+            validator=lambda text, user_info: is_valid_email(text),
+            retry="Некорректный email адрес. Пожалуйста, введите корректный адрес электронной почты или нажмите 'Пропустить'.",
+            next=(BIRTHDAY,)
+        ),
+        Step(
+            BIRTHDAY,
+            text=handle_birthday,
+            validator=lambda text, user_info: is_valid_birthday(text),
+            retry="Некорректная дата. Пожалуйста, введите дату в формате ДД.ММ.ГГГГ.",
+            next=(FINAL,)
+        ),
+        Step(
+            FINAL,
+            callbacks={
+                'confirm_yes': confirm_data,
+                'confirm_no': reject_data,
+                'personal_cabinet': open_personal_cabinet,
+                **{data: handler for data, (_, handler) in DATA_CHANGES.items()}
+            },
+            choices={label: handler for label, handler in DATA_CHANGES.values()},
+            text=unknown_data_change,
+            keyboards=(CONFIRMATION_KEYBOARD, CHANGE_DATA_KEYBOARD),
+            next=(MAIN_MENU, PERSONAL_CABINET, NAME_REQUEST, CONNECT, PLATFORM, ORDER_NUMBER, CONTACT, EMAIL, BIRTHDAY)
+        ),
+        Step(
+            MAIN_MENU,
+            callbacks={'personal_cabinet': open_personal_cabinet, 'main_menu': open_main_menu, 'test_info': show_test_info},
+            text=show_main_menu,
+            keyboards=(MAIN_MENU_KEYBOARD, PERSONAL_CABINET_KEYBOARD),
+            next=(PERSONAL_CABINET,)
+        ),
+        Step(
+            PERSONAL_CABINET,
+            callbacks={'main_menu': open_main_menu},
+            text=show_personal_cabinet,
+            keyboards=(PERSONAL_CABINET_KEYBOARD,),
+            next=(MAIN_MENU,)
+        ),
+    ],
+    fallback=Step(
+        'FALLBACK',
+        callbacks={'choose_platform': show_platforms},
+        next=(PLATFORM,)
+    ),
+    state_names=state_names
+)
+
+
+def main():
+    problems = FLOW.check()
+    for problem in problems:
+        print(problem)
+    print(f"{len(FLOW.steps)} states, {len(problems)} problems")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
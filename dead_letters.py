@@ -0,0 +1,111 @@
+"""Журнал исходящих сообщений, которые не удалось доставить.
+
+Каждая запись — строка JSON с чатом, методом бота и его аргументами. Объекты Telegram
+(клавиатуры) сохраняются через to_dict и восстанавливаются при повторной отправке.
+Повтор забирает журнал целиком и снова ставит записи в outbox; то, что опять не
+дошло, outbox запишет в журнал заново.
+"""
+import json
+import logging
+import os
+import time
+
+import telegram
+from telegram import TelegramObject
+
+logger = logging.getLogger(__name__)
+
+DEAD_LETTER_FILE = 'dead_letters.jsonl'
+
+
+def _encode(value):
+    if isinstance(value, TelegramObject):
+        return {'__telegram__': type(value).__name__, 'data': value.to_dict()}
+    raise TypeError(f"{type(value).__name__} is not serializable")
+
+
+def _decode(value, bot):
+    if isinstance(value, dict):
+        if '__telegram__' in value:
+            return getattr(telegram, value['__telegram__']).de_json(value['data'], bot)
+        return {key: _decode(item, bot) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item, bot) for item in value]
+    return value
+
+
+class DeadLetters:
+    def __init__(self, path: str = DEAD_LETTER_FILE):
+        self.path = path
+
+    def configure(self, path: str):
+        self.path = path
+
+    def record(self, chat_id, method: str, kwargs: dict, asset=None, error: Exception = None):
+        entry = {
+            'time': time.time(), 'chat_id': chat_id, 'method': method, 'asset': asset,
+            'error': f"{type(error).__name__}: {error}" if error else None
+        }
+        try:
+            line = json.dumps({**entry, 'kwargs': kwargs}, ensure_ascii=False, default=_encode)
+        except TypeError as e:
+            # Такую запись повторить нельзя, но в журнале должно остаться, что сообщение потеряно
+            line = json.dumps({**entry, 'kwargs': None, 'unreplayable': str(e)}, ensure_ascii=False, default=repr)
+        try:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(line + '\n')
+        except OSError as e:
+            logger.error("Could not write dead letter for chat %s: %s", chat_id, e)
+            return
+        logger.warning("Dead letter: %s for chat %s (%s)", method, chat_id, entry['error'])
+
+    def entries(self) -> list:
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                return [json.loads(line) for line in file if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def summary(self, last: int = 5) -> str:
+        entries = self.entries()
+        if not entries:
+            return "Недоставленных сообщений нет."
+        lines = [f"Недоставленных сообщений: {len(entries)}"]
+        for entry in entries[-last:]:
+            when = time.strftime('%d.%m %H:%M:%S', time.localtime(entry['time']))
+            lines.append(f"{when} {entry['method']} -> {entry['chat_id']}: {entry['error']}")
+        return '\n'.join(lines)
+
+    def replay(self, outbox) -> int:
+        """Ставит записи журнала в outbox. Возвращает число поставленных сообщений."""
+        taken = f"{self.path}.replay{os.getpid()}"
+        try:
+            os.replace(self.path, taken)
+        except FileNotFoundError:
+            return 0
+
+        submitted = 0
+        kept = []
+        with open(taken, encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get('unreplayable'):
+                    kept.append(line)
+                    continue
+                outbox.submit(
+                    entry['chat_id'], entry['method'],
+                    asset=tuple(entry['asset']) if entry['asset'] else None,
+                    **_decode(entry['kwargs'], outbox.bot)
+                )
+                submitted += 1
+        if kept:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.writelines(kept)
+        os.remove(taken)
+        logger.info("Replayed %s dead letters, %s kept", submitted, len(kept))
+        return submitted
+
+
+dead_letters = DeadLetters()
@@ -0,0 +1,125 @@
+"""Потоковая выгрузка анкет в CSV или JSONL.
+
+    python export.py --format csv --output profiles.csv
+    python export.py --format jsonl --output new.jsonl --incremental
+
+Записи читаются из хранилища сессий пачками по номеру версии, поэтому память не зависит
+от числа пользователей, а работающий бот не останавливается. С --incremental выгружаются
+только записи, изменившиеся после предыдущей инкрементальной выгрузки.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FIELDS = ('name', 'category', 'platform', 'order_number', 'contact', 'email', 'birthday')
+EXPORT_COLUMNS = ('user_id',) + PROFILE_FIELDS + ('updated_at',)
+EXPORT_BATCH_SIZE = 1000
+
+
+def watermark_key(name: str) -> str:
+    return f'export:version:{name}'
+
+
+def iter_profiles(backend, since: int = 0, completed_only: bool = True):
+    """Перебирает анкеты с версией больше since. Возвращает пары (версия, запись)."""
+    version = since
+    while True:
+        rows = backend.changed_since(version, EXPORT_BATCH_SIZE)
+        if not rows:
+            return
+        for user_id, data, updated_at, version in rows:
+            user_info = json.loads(data)
+            if completed_only and not all(field in user_info for field in PROFILE_FIELDS):
+                continue
+            record = {'user_id': user_id, 'updated_at': updated_at}
+            for field in PROFILE_FIELDS:
+                record[field] = user_info.get(field, '')
+            yield version, record
+
+
+def write_csv(records, file) -> int:
+    writer = csv.DictWriter(file, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    count = 0
+    for record in records:
+        writer.writerow(record)
+        count += 1
+    return count
+
+
+def write_jsonl(records, file) -> int:
+    count = 0
+    for record in records:
+        file.write(json.dumps(record, ensure_ascii=False))
+        file.write('\n')
+        count += 1
+    return count
+
+
+writers = {
+    'csv': write_csv,
+    'jsonl': write_jsonl
+}
+
+
+def export_profiles(backend, path: str, fmt: str = 'csv', incremental: bool = False,
+                    completed_only: bool = True, name: str = 'default') -> int:
+    """Выгружает анкеты в файл path и возвращает число записей.
+
+    При incremental версия последней выгруженной записи сохраняется в хранилище только после
+    успешной записи всего файла.
+    """
+    since = 0
+    if incremental:
+        stored = backend.get_meta(watermark_key(name))
+        if stored:
+            since = json.loads(stored)
+
+    last = [since]
+
+    def tracked(records):
+        for version, record in records:
+            last[0] = version
+            yield record
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as file:
+        count = writers[fmt](tracked(iter_profiles(backend, since, completed_only)), file)
+    os.replace(tmp_path, path)
+
+    if incremental and last[0] != since:
+        backend.put_meta(watermark_key(name), json.dumps(last[0]))
+    logger.info("Exported %s profiles to %s", count, path)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export questionnaire data")
+    parser.add_argument('--format', choices=sorted(writers), default='csv')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--incremental', action='store_true', help="only records changed since the last incremental export")
+    parser.add_argument('--all', action='store_true', help="include incomplete questionnaires")
+    parser.add_argument('--name', default='default', help="watermark name for incremental exports")
+    parser.add_argument('--db', help="SQLite session database; defaults to SESSION_DB")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    from storage import SQLiteBackend
+    backend = SQLiteBackend(args.db or os.getenv("SESSION_DB", "sessions.db"))
+    try:
+        count = export_profiles(backend, args.output, args.format, args.incremental, not args.all, args.name)
+    finally:
+        backend.close()
+    print(f"{count} records written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
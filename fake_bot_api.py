@@ -0,0 +1,338 @@
+"""Локальная замена Bot API для нагрузочных прогонов и проверки webhook без обращения к Telegram.
+
+    python fake_bot_api.py --port 8081 --latency 0.05 --rate-limit-prob 0.01
+
+Бот направляется на сервер через BOT_API_URL=http://127.0.0.1:8081. Адрес и секрет из setWebhook
+сервер запоминает, и deliver() отправляет на этот адрес апдейт так же, как Telegram: POST с JSON
+и заголовком X-Telegram-Bot-Api-Secret-Token.
+"""
+import argparse
+import itertools
+import json
+import logging
+import random
+import socket
+import threading
+import time
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qsl, urlsplit
+from urllib.request import Request, urlopen
+
+from telegram.request import BaseRequest
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+BOT_INFO = {
+    "id": 1000000001,
+    "is_bot": True,
+    "first_name": "MirrorSleep",
+    "username": "MirrorSleep_customer_bot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+_message_ids = itertools.count(1)
+_file_ids = itertools.count(1)
+
+
+def _decode(value: str):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _chat_id(params) -> int:
+    try:
+        return int(params.get("chat_id", 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _message(params, **extra) -> dict:
+    chat_id = _chat_id(params)
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": BOT_INFO["id"], "is_bot": True, "first_name": BOT_INFO["first_name"]},
+    }
+    if isinstance(params.get("text"), str):
+        message["text"] = params["text"]
+    if "reply_markup" in params and isinstance(params["reply_markup"], dict):
+        if "inline_keyboard" in params["reply_markup"]:
+            message["reply_markup"] = params["reply_markup"]
+    message.update(extra)
+    return message
+
+
+def _photo():
+    file_id = f"photo-{next(_file_ids)}"
+    return [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 720}]
+
+
+def _document():
+    file_id = f"document-{next(_file_ids)}"
+    return {"file_id": file_id, "file_unique_id": file_id, "file_name": "document.pdf"}
+
+
+def fake_response(method: str, params: dict):
+    """Правдоподобный результат вызова метода Bot API."""
+    method = method.lower()
+    if method == "getme":
+        return BOT_INFO
+    if method == "getupdates":
+        return []
+    if method == "getwebhookinfo":
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+    if method in ("sendmessage", "editmessagetext", "editmessagereplymarkup"):
+        return _message(params)
+    if method == "sendphoto":
+        return _message(params, photo=_photo())
+    if method == "senddocument":
+        return _message(params, document=_document())
+    if method == "sendmediagroup":
+        media = params.get("media") or []
+        return [
+            _message(params, photo=_photo(), media_group_id="1", caption=item.get("caption", ""))
+            for item in media
+        ]
+    return True
+
+
+class FakeBotApi:
+    """HTTP-сервер с заданной задержкой ответа и долей ответов 429 Too Many Requests."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 rate_limit_prob: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_prob = rate_limit_prob
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self._lock = threading.Lock()
+        self._updates = []
+        self._has_updates = threading.Condition(self._lock)
+        self.webhook_url = ""
+        self.webhook_secret = None
+        self._webhook_set = threading.Event()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+            def do_GET(self):
+                if self.path == "/stats":
+                    self._reply(200, api.stats())
+                else:
+                    self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                params = self._parse(body)
+                payload = api.handle(method, params)
+                self._reply(payload.get("error_code", 200), payload)
+
+            def _parse(self, body: bytes) -> dict:
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("multipart/form-data"):
+                    message = BytesParser(policy=HTTP).parsebytes(
+                        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+                    )
+                    params = {}
+                    for part in message.iter_parts():
+                        name = part.get_param("name", header="content-disposition")
+                        if name and part.get_filename() is None:
+                            params[name] = _decode(part.get_content().strip())
+                    return params
+                if content_type.startswith("application/json"):
+                    return json.loads(body or b"{}")
+                return {key: _decode(value) for key, value in parse_qsl(body.decode())}
+
+            def _reply(self, status: int, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def push_updates(self, updates):
+        """Ставит апдейты в очередь, которую отдает getUpdates."""
+        with self._has_updates:
+            self._updates.extend(updates)
+            self._has_updates.notify_all()
+
+    def get_updates(self, params: dict) -> list:
+        """getUpdates с подтверждением по offset и ожиданием до timeout секунд, как у Telegram."""
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._has_updates:
+            self.calls["getUpdates"] += 1
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._has_updates.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def set_webhook(self, params: dict) -> bool:
+        with self._lock:
+            self.calls["setWebhook"] += 1
+            self.webhook_url = params.get("url") or ""
+            self.webhook_secret = params.get("secret_token")
+        if self.webhook_url:
+            self._webhook_set.set()
+        else:
+            self._webhook_set.clear()
+        return True
+
+    def wait_for_webhook(self, timeout: float = None) -> bool:
+        """Ждет, пока бот вызовет setWebhook с непустым адресом."""
+        return self._webhook_set.wait(timeout)
+
+    def wait_for_listener(self, timeout: float) -> bool:
+        """Ждет, пока на адресе из setWebhook начнут принимать TCP-соединения."""
+        address = urlsplit(self.webhook_url)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                with socket.create_connection((address.hostname, address.port or 80), timeout=1):
+                    return True
+            except OSError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.05)
+
+    def deliver(self, update: dict, secret_token: str = None, timeout: float = 10) -> int:
+        """Отправляет апдейт на адрес из setWebhook и возвращает HTTP-статус ответа бота.
+
+        По умолчанию передается секрет из setWebhook; другой secret_token проверяет, что бот его отвергает.
+        Если до бота не удалось достучаться, возвращается 0.
+        """
+        token = self.webhook_secret if secret_token is None else secret_token
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers[SECRET_TOKEN_HEADER] = token
+        request = Request(self.webhook_url, data=json.dumps(update, ensure_ascii=False).encode(), headers=headers)
+        try:
+            with urlopen(request, timeout=timeout) as response:
+                return response.status
+        except HTTPError as e:
+            return e.code
+        except (URLError, OSError) as e:
+            logger.warning("Could not deliver update %s to %s: %s", update.get("update_id"), self.webhook_url, e)
+            return 0
+
+    def handle(self, method: str, params: dict) -> dict:
+        if method.lower() == "getupdates":
+            return {"ok": True, "result": self.get_updates(params)}
+        if method.lower() == "setwebhook":
+            return {"ok": True, "result": self.set_webhook(params)}
+        if method.lower() == "deletewebhook":
+            return {"ok": True, "result": self.set_webhook({})}
+        if method.lower() == "getwebhookinfo":
+            return {"ok": True, "result": {"url": self.webhook_url, "has_custom_certificate": False,
+                                           "pending_update_count": 0}}
+        delay = self.latency + random.uniform(0, self.jitter) if self.jitter else self.latency
+        if delay:
+            time.sleep(delay)
+
+        limited = self.rate_limit_prob and method.lower() != "getme" and random.random() < self.rate_limit_prob
+        with self._lock:
+            self.calls[method] += 1
+            if limited:
+                self.rate_limited[method] += 1
+        if limited:
+            return {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        return {"ok": True, "result": fake_response(method, params)}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": dict(self.calls), "rate_limited": dict(self.rate_limited)}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-bot-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class OfflineRequest(BaseRequest):
+    """Запрос к Bot API, на который отвечает fake_response в том же процессе, без HTTP."""
+
+    def __init__(self):
+        self.calls = Counter()
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rstrip("/").rsplit("/", 1)[-1]
+        params = {key: _decode(value) for key, value in request_data.json_parameters.items()} if request_data else {}
+        self.calls[api_method] += 1
+        return 200, json.dumps({"ok": True, "result": fake_response(api_method, params)}, ensure_ascii=False).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="base delay per call, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random delay per call, seconds")
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    api = FakeBotApi(args.host, args.port, args.latency, args.jitter, args.rate_limit_prob, args.retry_after)
+    logger.info("Fake Bot API listening on %s", api.url)
+    try:
+        api._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Движок декларативного диалога.
+
+Диалог описывается списком шагов Step: какие команды, тексты, контакты и кнопки принимаются
+в состоянии, чем проверяется ввод и в какие состояния можно перейти. Flow собирает из
+описания ConversationHandler, где каждое состояние обслуживается одним обработчиком на вид
+апдейта, а нужная функция находится по словарю, а не перебором шаблонов. Шаг fallback
+описывает кнопки, которые работают в любом состоянии диалога: они попадают в fallbacks, и
+ConversationHandler переходит в возвращенное ими состояние. По тому же описанию check()
+находит недостижимые состояния и кнопки, которые никто не обрабатывает.
+
+Состояние диалога хранится в поле stage сессии. ConversationHandler помнит его только в памяти
+процесса, поэтому после перезапуска или переезда пользователя в другой процесс апдейт
+подхватывает ResumeHandler: он находит обработчик по сохраненному состоянию.
+"""
+import logging
+
+from telegram import InlineKeyboardMarkup, Update
+from telegram.ext import BaseHandler, CallbackQueryHandler, CommandHandler, ConversationHandler, MessageHandler, filters
+
+from sizing import estimate
+from storage import sessions
+
+logger = logging.getLogger(__name__)
+
+TEXT = filters.TEXT & ~filters.COMMAND
+
+
+def keyboard_callbacks(markup) -> set:
+    if not isinstance(markup, InlineKeyboardMarkup):
+        return set()
+    return {
+        button.callback_data
+        for row in markup.inline_keyboard for button in row
+        if isinstance(button.callback_data, str)
+    }
+
+
+class Step:
+    """Состояние диалога.
+
+    commands, callbacks и choices — словари команда/данные кнопки/точный текст -> обработчик.
+    text и contact обрабатывают остальной текст
+    и присланный контакт. validator(text, user_info) проверяет текст до вызова text, при ошибке
+    пользователю отправляется retry — строка или функция от user_info. keyboards — клавиатуры,
+    которые видит пользователь в этом состоянии, next — состояния, которые возвращают обработчики.
+    """
+
+    __slots__ = ('state', 'commands', 'callbacks', 'choices', 'text', 'contact',
+                 'validator', 'retry', 'keyboards', 'next')
+
+    def __init__(self, state, commands=None, callbacks=None, choices=None, text=None,
+                 contact=None, validator=None, retry=None, keyboards=(), next=()):
+        self.state = state
+        self.commands = commands or {}
+        self.callbacks = callbacks or {}
+        self.choices = choices or {}
+        self.text = text
+        self.contact = contact
+        self.validator = validator
+        self.retry = retry
+        self.keyboards = keyboards
+        self.next = frozenset(next)
+
+    def route(self, data):
+        if not isinstance(data, str):
+            return None
+        return self.callbacks.get(data)
+
+
+def stored_state(update):
+    """Состояние диалога из сессии пользователя или None."""
+    user = update.effective_user
+    session = sessions.get(user.id) if user else None
+    return session.get('stage') if session is not None else None
+
+
+def remember_state(update, state):
+    user = update.effective_user
+    session = sessions.get(user.id) if user else None
+    if session is None:
+        return
+    if state == ConversationHandler.END:
+        sessions.pop(user.id, 'stage')
+    elif session.get('stage') != state:
+        sessions.update(user.id, stage=state)
+
+
+class ResumeHandler(BaseHandler):
+    """Точка входа для пользователя, о диалоге которого ConversationHandler не знает.
+
+    Апдейт передается обработчику состояния, сохраненного в сессии, или обработчику из
+    fallbacks; то, что он вернет, ConversationHandler запомнит как текущее состояние.
+    """
+
+    def __init__(self, states: dict, fallbacks: list):
+        super().__init__(callback=None)
+        self.states = states
+        self.fallbacks = fallbacks
+
+    def check_update(self, update):
+        if not isinstance(update, Update):
+            return None
+        state = stored_state(update)
+        if state is None:
+            return None
+        for handler in list(self.states.get(state, ())) + self.fallbacks:
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                return handler, check
+        return None
+
+    async def handle_update(self, update, application, check_result, context):
+        handler, check = check_result
+        return await handler.handle_update(update, application, check, context)
+
+
+class FlowConversationHandler(ConversationHandler):
+    def forget(self, user_id):
+        """Забывает состояние диалога пользователя, чья сессия выгружена из кеша.
+
+        Бот работает в личных чатах, где chat_id совпадает с user_id. При следующем апдейте
+        состояние восстановит ResumeHandler из поля stage сессии.
+        """
+        self._conversations.pop((user_id, user_id), None)
+
+    def memory_usage(self) -> list:
+        # PTB не дает публичного доступа к состояниям диалогов, поэтому он только в этом классе
+        conversations = self._conversations
+        return [('conversations', len(conversations), estimate(conversations))]
+
+
+class Flow:
+    def __init__(self, entry: Step, steps, fallback: Step = None, state_names=None):
+        self.entry = entry
+        self.steps = {step.state: step for step in steps}
+        self.fallback = fallback
+        self.state_names = state_names or {}
+        self._observers = []
+
+    def add_observer(self, observer):
+        """observer(source, target, update) вызывается после каждого обработчика, вернувшего состояние."""
+        if observer not in self._observers:
+            self._observers.append(observer)
+
+    def name(self, state) -> str:
+        return self.state_names.get(state, str(state))
+
+    def _wrapped(self, step: Step, label: str, wrap):
+        """Копия шага, в которой каждый обработчик обернут wrap(label, handler)."""
+        if wrap is None:
+            return step
+
+        def table(handlers):
+            return {key: wrap(label, handler) for key, handler in handlers.items()}
+
+        return Step(
+            step.state, table(step.commands), table(step.callbacks), table(step.choices),
+            step.text and wrap(label, step.text), step.contact and wrap(label, step.contact),
+            step.validator, step.retry, step.keyboards, step.next
+        )
+
+    def _checked(self, step: Step, handler):
+        """Вызывает обработчик и предупреждает о переходе, которого нет в описании."""
+        async def call(update, context):
+            result = await handler(update, context)
+            if result is not None and result != step.state and result != ConversationHandler.END and result not in step.next:
+                logger.warning("Undeclared transition %s -> %s", self.name(step.state), self.name(result))
+            if result is not None:
+                remember_state(update, result)
+                for observer in self._observers:
+                    observer(step.state, result, update)
+            return result
+
+        return call
+
+    def _handlers(self, step: Step) -> list:
+        handlers = []
+        for command, handler in step.commands.items():
+            handlers.append(CommandHandler(command, self._checked(step, handler)))
+
+        if step.callbacks:
+            async def on_callback(update, context):
+                return await step.route(update.callback_query.data)(update, context)
+
+            handlers.append(CallbackQueryHandler(
+                self._checked(step, on_callback), pattern=lambda data: step.route(data) is not None
+            ))
+
+        if step.choices or step.text:
+            async def on_text(update, context):
+                text = update.message.text
+                handler = step.choices.get(text)
+                if handler is not None:
+                    return await handler(update, context)
+                if step.text is None:
+                    return None
+                if step.validator is not None:
+                    user_info = sessions.get(update.effective_user.id) or {}
+                    if not step.validator(text, user_info):
+                        retry = step.retry(user_info) if callable(step.retry) else step.retry
+                        await update.message.reply_text(retry)
+                        return step.state
+                return await step.text(update, context)
+
+            handlers.append(MessageHandler(TEXT, self._checked(step, on_text)))
+
+        if step.contact:
+            handlers.append(MessageHandler(filters.CONTACT, self._checked(step, step.contact)))
+        return handlers
+
+    def build(self, wrap=None) -> ConversationHandler:
+        """Собирает ConversationHandler. wrap(label, handler) оборачивает каждый обработчик, например замером времени."""
+        states = {
+            state: self._handlers(self._wrapped(step, self.name(state), wrap))
+            for state, step in self.steps.items()
+        }
+        entry = self._handlers(self._wrapped(self.entry, 'START', wrap))
+        # Команды точки входа работают и посреди диалога, как раньше, когда fallback был равен entry
+        fallbacks = list(entry)
+        if self.fallback is not None:
+            fallbacks += self._handlers(self._wrapped(self.fallback, 'FALLBACK', wrap))
+        return FlowConversationHandler(
+            entry_points=entry + [ResumeHandler(states, fallbacks)],
+            states=states,
+            fallbacks=fallbacks,
+        )
+
+    def check(self) -> list:
+        """Статическая проверка описания. Возвращает список найденных проблем."""
+        problems = []
+        roots = [step for step in (self.entry, self.fallback) if step]
+        every = roots + list(self.steps.values())
+
+        for step in every:
+            for state in step.next - self.steps.keys():
+                problems.append(f"{self.name(step.state)}: transition to undeclared state {self.name(state)}")
+
+        reachable = set()
+        pending = [state for step in roots for state in step.next]
+        while pending:
+            state = pending.pop()
+            if state in reachable or state not in self.steps:
+                continue
+            reachable.add(state)
+            pending.extend(self.steps[state].next)
+        for state in self.steps.keys() - reachable:
+            problems.append(f"{self.name(state)}: unreachable state")
+
+        shown = set()
+        for step in every:
+            for markup in step.keyboards:
+                for data in keyboard_callbacks(markup):
+                    shown.add(data)
+                    if step.route(data) is None and (self.fallback is None or self.fallback.route(data) is None):
+                        problems.append(f"{self.name(step.state)}: button {data!r} has no handler")
+
+        for step in every:
+            for data in step.callbacks.keys() - shown:
+                problems.append(f"{self.name(step.state)}: callback {data!r} is handled but no keyboard sends it")
+        return problems
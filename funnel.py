@@ -0,0 +1,163 @@
+"""Счетчики воронки анкеты: сколько раз пользователи переходили из состояния в состояние.
+
+Переход учитывается с площадкой и категорией пользователя. Счетчики лежат в заранее
+выделенных массивах — по одному на часовой интервал, интервалы идут по кольцу, — поэтому
+запись перехода — это вычисление индекса и одно сложение. При каждой записи сессий
+прибавившееся с прошлого раза уходит в таблицу funnel хранилища, откуда /funnel
+собирает отчет за нужное число часов по всем процессам.
+"""
+import asyncio
+import logging
+import time
+from array import array
+
+from storage import sessions
+from config import (
+    CONNECT, NAME_REQUEST, CONSENT, PLATFORM, ORDER_NUMBER_PROMPT, ORDER_NUMBER, CONTACT, EMAIL, BIRTHDAY, FINAL,
+    MAIN_MENU, category_cases, platforms, state_names
+)
+
+logger = logging.getLogger(__name__)
+
+BUCKET_SECONDS = 3600
+BUCKETS = 24
+OTHER = 'other'
+END = 'END'
+
+# Порядок состояний в отчете
+FUNNEL = (CONNECT, NAME_REQUEST, CONSENT, PLATFORM, ORDER_NUMBER_PROMPT, ORDER_NUMBER, CONTACT, EMAIL, BIRTHDAY,
+          FINAL, MAIN_MENU)
+# Площадка известна только после ответа в PLATFORM: переходы до этого учтены как other
+PLATFORM_FUNNEL = FUNNEL[FUNNEL.index(ORDER_NUMBER_PROMPT):]
+
+
+class Funnel:
+    def __init__(self, bucket_seconds: int = BUCKET_SECONDS, buckets: int = BUCKETS):
+        self.bucket_seconds = bucket_seconds
+        self.sources = ['START', 'FALLBACK'] + [state_names[state] for state in sorted(state_names)]
+        self.targets = [state_names[state] for state in sorted(state_names)] + [END]
+        self.platforms = [platform['name'] for platform in platforms] + [OTHER]
+        self.categories = list(category_cases) + [OTHER]
+        # Индексы перехода считаются заранее: в record остаются только поиски в словарях
+        self._source_index = {state: i for i, state in enumerate(['START', 'FALLBACK'] + sorted(state_names))}
+        self._target_index = {state: i for i, state in enumerate(sorted(state_names))}
+        self._target_index[-1] = len(self.targets) - 1
+        self._platform_index = {name: i for i, name in enumerate(self.platforms[:-1])}
+        self._category_index = {name: i for i, name in enumerate(self.categories[:-1])}
+        self.cells = len(self.sources) * len(self.targets) * len(self.platforms) * len(self.categories)
+        self._slots = [self._zeros() for _ in range(buckets)]
+        self._flushed = [self._zeros() for _ in range(buckets)]
+        self._epochs = [-1] * buckets
+        self._unflushed = set()
+        self._failed = []
+        self._store = None
+
+    def memory_usage(self) -> list:
+        slots = self._slots + self._flushed
+        return [('funnel', self.cells * len(self._slots), sum(len(slot) * slot.itemsize for slot in slots))]
+
+    def _zeros(self) -> array:
+        return array('I', bytes(array('I').itemsize * self.cells))
+
+    def cell(self, source, target, platform: str, category: str) -> int:
+        index = self._source_index[source] * len(self.targets) + self._target_index[target]
+        index = index * len(self.platforms) + self._platform_index.get(platform, len(self.platforms) - 1)
+        return index * len(self.categories) + self._category_index.get(category, len(self.categories) - 1)
+
+    def decode(self, cell: int) -> tuple:
+        cell, category = divmod(cell, len(self.categories))
+        cell, platform = divmod(cell, len(self.platforms))
+        source, target = divmod(cell, len(self.targets))
+        return self.sources[source], self.targets[target], self.platforms[platform], self.categories[category]
+
+    def _slot(self) -> int:
+        epoch = int(time.time()) // self.bucket_seconds
+        slot = epoch % len(self._slots)
+        if self._epochs[slot] != epoch:
+            self._rotate(slot, epoch)
+        return slot
+
+    def _rotate(self, slot: int, epoch: int):
+        # Слот переиспользуется через len(self._slots) интервалов; несохраненное к этому времени уже записано
+        if slot in self._unflushed:
+            logger.warning("Funnel bucket %s is reused before it was flushed", self._epochs[slot])
+        self._slots[slot] = self._zeros()
+        self._flushed[slot] = self._zeros()
+        self._epochs[slot] = epoch
+        self._unflushed.add(slot)
+
+    def record(self, source, target, user_info):
+        """Учитывает переход source -> target. Неизвестные состояния не учитываются."""
+        if target not in self._target_index or source not in self._source_index:
+            return
+        user_info = user_info or {}
+        self._slots[self._slot()][self.cell(source, target, user_info.get('platform'), user_info.get('category'))] += 1
+
+    def observe(self, source, target, update):
+        """Наблюдатель для Flow.add_observer."""
+        user = update.effective_user
+        self.record(source, target, sessions.get(user.id) if user else None)
+
+    def _pending_rows(self) -> list:
+        rows = []
+        for slot in self._unflushed:
+            bucket = self._epochs[slot] * self.bucket_seconds
+            current, flushed = self._slots[slot], self._flushed[slot]
+            for cell, count in enumerate(current):
+                if count != flushed[cell]:
+                    rows.append((bucket,) + self.decode(cell) + (count - flushed[cell],))
+            self._flushed[slot] = array('I', current)
+        current = self._slot()
+        self._unflushed = {current}
+        return rows
+
+    def start(self, store):
+        self._store = store
+
+    async def flush(self):
+        if self._store is None:
+            return
+        rows = self._failed + self._pending_rows()
+        if not rows:
+            return
+        self._failed = []
+        try:
+            await asyncio.to_thread(self._store.backend.add_funnel, rows)
+        except Exception:
+            self._failed = rows
+            raise
+
+    async def report(self, hours: int = 24, segment: str = None) -> str:
+        """Отчет по хранилищу за последние hours часов; segment — площадка или категория."""
+        since = int(time.time()) - hours * 3600
+        since -= since % self.bucket_seconds
+        await self.flush()
+        rows = await asyncio.to_thread(self._store.backend.funnel_counts, since)
+
+        reached, retries = {}, {}
+        for source, target, platform, category, count in rows:
+            if segment and segment not in (platform, category):
+                continue
+            if source == target:
+                retries[target] = retries.get(target, 0) + count
+            else:
+                reached[target] = reached.get(target, 0) + count
+
+        title = f"Воронка за {hours} ч" + (f", {segment}" if segment else "")
+        if not reached:
+            return f"{title}: переходов нет."
+        states = PLATFORM_FUNNEL if segment in self.platforms else FUNNEL
+        lines = [title]
+        if states is PLATFORM_FUNNEL:
+            lines.append("Состояния до выбора площадки по площадкам не делятся.")
+        lines.append(f"состояние: вошли / повторы / от вошедших в {state_names[states[0]]}")
+        base = reached.get(state_names[states[0]])
+        for state in states:
+            name = state_names[state]
+            count = reached.get(name, 0)
+            share = f"{count * 100 / base:.0f}%" if base else "-"
+            lines.append(f"{name}: {count} / {retries.get(name, 0)} / {share}")
+        return '\n'.join(lines)
+
+
+funnel = Funnel()
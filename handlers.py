@@ -1,37 +1,85 @@
-import asyncio
 import logging
-import re
-from telegram import InputMediaPhoto, Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from contextlib import ExitStack
+from telegram import InputMediaPhoto, Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import CallbackContext
 from qr_codes import get_product_category
-from utils import is_cyrillic, send_messages
-from config import CONNECT, NAME_REQUEST, CONSENT, PLATFORM, ORDER_NUMBER, CONTACT, EMAIL, BIRTHDAY, FINAL, MAIN_MENU, PERSONAL_CABINET, ORDER_NUMBER_PROMPT, messages, photo_paths, category_cases, platforms
+from asset_cache import asset_cache, sent_file_id
+from utils import is_cyrillic, send_messages, delete_messages
+from storage import sessions
+from outbox import outbox
+from dead_letters import dead_letters
+from retry import is_transient
+from orders import DUPLICATE_ORDER_MESSAGE, normalize_order_number, order_index
+from logging_setup import SAMPLED
+from render import render_intro, render_subscribe
+from render_state import edit_message
+from keyboards import (
+    MAIN_MENU_KEYBOARD, PLATFORM_KEYBOARD, CHANGE_DATA_KEYBOARD, SWITCH_TO_ORDER_KEYBOARD, CONTACT_KEYBOARD,
+    EMAIL_KEYBOARD, CONFIRMATION_KEYBOARD, PERSONAL_CABINET_KEYBOARD, CONNECT_REPLY_KEYBOARD, ACCEPT_KEYBOARD,
+    REMOVE_KEYBOARD
+)
+from config import CONNECT, NAME_REQUEST, CONSENT, PLATFORM, ORDER_NUMBER, CONTACT, EMAIL, BIRTHDAY, FINAL, MAIN_MENU, PERSONAL_CABINET, ORDER_NUMBER_PROMPT, messages, photo_paths
 
 logger = logging.getLogger(__name__)
 
-user_data = {}
+# Вопрос, который /start задает заново, если анкета прервалась на этом состоянии
+RESUME_PROMPTS = {
+    CONNECT: (messages['welcome'], CONNECT_REPLY_KEYBOARD),
+    NAME_REQUEST: ("Пожалуйста, введите свое имя на русском языке.", None),
+    CONSENT: ("Пожалуйста, ознакомьтесь с согласием на обработку данных. Нажмите 'Принять', если вы согласны с условиями.",
+              ACCEPT_KEYBOARD),
+    PLATFORM: (messages['choose_platform'], PLATFORM_KEYBOARD),
+    ORDER_NUMBER_PROMPT: ("Вы готовы ввести номер заказа?", SWITCH_TO_ORDER_KEYBOARD),
+    ORDER_NUMBER: ("Пожалуйста, введите номер вашего заказа.", None),
+    CONTACT: (messages['contact_button'], CONTACT_KEYBOARD),
+    EMAIL: (messages['email_request'], EMAIL_KEYBOARD),
+    BIRTHDAY: (messages['birthday_request'], REMOVE_KEYBOARD),
+}
 
 async def start(update: Update, context: CallbackContext) -> int:
     user_id = update.message.from_user.id
 
-    if user_id in user_data:
-        return await show_main_menu(update, context)
+    user_info = sessions.get(user_id)
+    if user_info is not None:
+        if user_info.get('active') is False:
+            # Пользователь, заблокировавший бота, вернулся и снова получает рассылки
+            sessions.update(user_id, active=True)
+        # Анкета, прерванная перезапуском или переездом в другой процесс, продолжается с того же вопроса
+        stage = user_info.get('stage')
+        if stage not in RESUME_PROMPTS:
+            return await show_main_menu(update, context)
+        text, keyboard = RESUME_PROMPTS[stage]
+        await update.message.reply_text(text, reply_markup=keyboard)
+        return stage
 
     args = context.args
     category = get_product_category(args[0]) if args else 'Unknown category'
 
-    user_data[user_id] = {
-        'name': update.message.from_user.first_name, 
-        'category': category
-    }
+    sessions.create(
+        user_id,
+        name=update.message.from_user.first_name,
+        category=category
+    )
 
     await update.message.reply_text(
         messages['welcome'],
-        reply_markup=ReplyKeyboardMarkup([['Подключиться']], one_time_keyboard=True)
+        reply_markup=CONNECT_REPLY_KEYBOARD
     )
     
     return CONNECT
 
+async def show_screen(update: Update, message, text: str, reply_markup):
+    """Экран меню: по нажатию кнопки редактирует ее сообщение, на текст или команду отвечает новым.
+
+    Редактировать можно только сообщения бота, а сообщение пользователя — нельзя.
+    Повторное нажатие той же кнопки не делает запроса.
+    """
+    if update.callback_query:
+        await edit_message(message, text=text, reply_markup=reply_markup)
+    else:
+        await message.reply_text(text, reply_markup=reply_markup)
+
 async def show_main_menu(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     if query:
@@ -41,36 +89,26 @@ async def show_main_menu(update: Update, context: CallbackContext) -> int:
         user_id = update.message.from_user.id
         message = update.message
 
-    user_data.setdefault(user_id, {})
-
-    # Обновление текста сообщения и кнопок
-    await message.edit_text(
+    await show_screen(
+        update, message,
         text="Привет! Вы в главном меню.\n\n"
              "1. Используйте кнопки ниже для навигации.\n"
              "2. Вы можете управлять своими данными или перейти в личный кабинет.",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Личный кабинет", callback_data="personal_cabinet")],
-            [InlineKeyboardButton("Тестовая информация", callback_data="test_info")]
-        ])
+        reply_markup=MAIN_MENU_KEYBOARD
     )
 
-    user_data[user_id]['stage'] = MAIN_MENU
+    sessions.update(user_id, stage=MAIN_MENU)
     return MAIN_MENU
 
 
 async def request_name(update: Update, context: CallbackContext) -> int:
     user_id = update.message.from_user.id
-    user_data[user_id]['name'] = update.message.text
-
-    if not is_cyrillic(user_data[user_id]['name']):
-        await update.message.reply_text("Пожалуйста, введите свое имя на русском языке.")
-        return NAME_REQUEST
-    
+    sessions.update(user_id, name=update.message.text)
     return await send_intro_message(update, context)
 
 async def send_intro_message(update: Update, context: CallbackContext) -> int:
     user_id = update.message.from_user.id
-    user_info = user_data[user_id]
+    user_info = sessions.get(user_id)
 
     if not is_cyrillic(user_info['name']):
         await update.message.reply_text("Пожалуйста, введите свое имя на русском языке.")
@@ -79,7 +117,7 @@ async def send_intro_message(update: Update, context: CallbackContext) -> int:
     intro_message = get_intro_message(user_info)
     await send_messages(update.message, context, [
         intro_message, 
-        messages["subscribe"].format(category=category_cases.get(user_info['category'])), 
+        render_subscribe(user_info['category']), 
         messages["friendship"], 
         messages["questions"]
     ], parse_mode='HTML')
@@ -87,33 +125,23 @@ async def send_intro_message(update: Update, context: CallbackContext) -> int:
     return await request_consent(update, context)
 
 def get_intro_message(user_info):
-    if user_info['category'] == 'Постельное белье':
-        return messages["intro_bed_linen"].format(name=user_info['name'], category=user_info['category'])
-    elif user_info['category'] == 'Полотенца':
-        return messages["intro_towel"].format(name=user_info['name'], category=user_info['category'])
-    elif user_info['category'] == 'Пледы':
-        return messages["intro_blanket"].format(name=user_info['name'], category=user_info['category'])
-    return ""
+    return render_intro(user_info)
 
 async def request_consent(update: Update, context: CallbackContext) -> int:
     user_id = update.message.from_user.id
-    user_data[user_id]['stage'] = CONSENT
-
-    await update.message.reply_text(messages["info_use"])
-    await asyncio.sleep(2)
-
-    consent_file = 'documents/soglasie.pdf'
-    try:
-        with open(consent_file, 'rb') as file:
-            await context.bot.send_document(chat_id=update.effective_chat.id, document=file)
-    except Exception as e:
-        logger.error(f"Error sending consent file: {e}")
-        await update.message.reply_text("Произошла ошибка при отправке файла. Пожалуйста, попробуйте позже.")
-        return PLATFORM
-
-    await update.message.reply_text(
-        "Пожалуйста, ознакомьтесь с согласием на обработку данных. Нажмите 'Принять', если вы согласны с условиями.",
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Принять", callback_data='accept')]])
+    chat_id = update.effective_chat.id
+    sessions.update(user_id, stage=CONSENT)
+
+    outbox.submit(chat_id, 'send_message', paced=True, text=messages["info_use"])
+    outbox.submit(
+        chat_id, 'send_document',
+        asset=('document', 'documents/soglasie.pdf'),
+        error_text="Произошла ошибка при отправке файла. Пожалуйста, попробуйте позже."
+    )
+    outbox.submit(
+        chat_id, 'send_message',
+        text="Пожалуйста, ознакомьтесь с согласием на обработку данных. Нажмите 'Принять', если вы согласны с условиями.",
+        reply_markup=ACCEPT_KEYBOARD
     )
     
     return CONSENT
@@ -126,32 +154,24 @@ async def handle_consent(update: Update, context: CallbackContext) -> int:
     try:
         await query.message.delete()
     except Exception as e:
-        logger.warning(f"Could not delete message {query.message.message_id}: {e}")
+        logger.warning("Could not delete message %s: %s", query.message.message_id, e)
 
     await query.message.reply_text(
         "Спасибо за ваше согласие. Теперь выберите платформу, на которой приобретали нашу продукцию.",
-        reply_markup=generate_platform_buttons()
+        reply_markup=PLATFORM_KEYBOARD
     )
     return PLATFORM
 
-def generate_platform_buttons():
-    buttons = [[InlineKeyboardButton(platform["name"], callback_data=platform["callback_data"])] for platform in platforms]
-    return InlineKeyboardMarkup(buttons)
-
 async def handle_platform_choice(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     user_id = query.from_user.id
     platform = query.data
-    user_data[user_id]['platform'] = platform
+    sessions.update(user_id, platform=platform)
     await query.answer()
 
-    if 'instruction_message_ids' in user_data[user_id]:
-        for message_id in user_data[user_id]['instruction_message_ids']:
-            try:
-                await context.bot.delete_message(chat_id=query.message.chat_id, message_id=message_id)
-            except Exception as e:
-                logger.warning(f"Could not delete message {message_id}: {e}")
-        user_data[user_id].pop('instruction_message_ids', None)
+    instruction_message_ids = sessions.pop(user_id, 'instruction_message_ids')
+    if instruction_message_ids:
+        await delete_messages(context.bot, query.message.chat_id, instruction_message_ids)
 
     new_message_ids = []
 
@@ -159,32 +179,53 @@ async def handle_platform_choice(update: Update, context: CallbackContext) -> in
 
     ready_message = await query.message.reply_text(
         f"Вы выбрали платформу: {platform}. Вы готовы ввести номер заказа?",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Да", callback_data='switch_state_to_order')],
-            [InlineKeyboardButton("Назад", callback_data='choose_platform')]
-        ])
+        reply_markup=SWITCH_TO_ORDER_KEYBOARD
     )
     new_message_ids.append(ready_message.message_id)
 
-    user_data[user_id]['instruction_message_ids'] = new_message_ids
+    sessions.update(user_id, instruction_message_ids=new_message_ids)
 
     return ORDER_NUMBER_PROMPT
 
+async def send_instruction_media(context: CallbackContext, chat_id: int, photos: list) -> list:
+    """Отправляет шаги инструкции одним альбомом с подписями и возвращает отправленные сообщения."""
+    while True:
+        with ExitStack() as stack:
+            files = [stack.enter_context(asset_cache.input_file(photo['path'])) for photo in photos]
+            media = [InputMediaPhoto(file, caption=photo['text']) for photo, file in zip(photos, files)]
+            try:
+                sent = await context.bot.send_media_group(chat_id=chat_id, media=media)
+            except BadRequest:
+                # Устаревший file_id приходит как BadRequest; после сетевого сбоя кеш остается.
+                # Файлы с забытыми file_id один раз загружаются заново, тому же пользователю
+                cached = [photo['path'] for photo, file in zip(photos, files) if isinstance(file, str)]
+                if not cached:
+                    raise
+                for path in cached:
+                    asset_cache.forget(path)
+                continue
+        break
+
+    for photo, message in zip(photos, sent):
+        asset_cache.remember(photo['path'], sent_file_id(message))
+    return sent
+
 async def send_platform_instructions(context: CallbackContext, query: Update, platform: str, message_ids: list):
     photos = photo_paths.get(platform, [])
     if photos:
-        for photo in photos:
-            try:
-                with open(photo['path'], 'rb') as photo_file:
-                    message = await context.bot.send_photo(chat_id=query.message.chat_id, photo=photo_file)
-                    message_ids.append(message.message_id) 
-                    text_message = await query.message.reply_text(photo['text'])
-                    message_ids.append(text_message.message_id)
-            except Exception as e:
-                logger.error(f"Error sending photo {photo['path']}: {e}")
-                error_message = await query.message.reply_text("Произошла ошибка при отправке фото. Пожалуйста, попробуйте позже.")
-                message_ids.append(error_message.message_id)  
-                return
+        try:
+            sent = await send_instruction_media(context, query.message.chat_id, photos)
+            message_ids.extend(message.message_id for message in sent)
+            logger.info("Sent photo instructions to user %s for platform %s", query.from_user.id, platform, extra=SAMPLED)
+        except Exception as e:
+            logger.error("Error sending instructions for platform %s: %s", platform, e)
+            if isinstance(e, RetryAfter) or is_transient(e):
+                # В outbox нет альбомов, поэтому в журнал шаги попадают отдельными фото с подписями
+                for photo in photos:
+                    dead_letters.record(query.message.chat_id, 'send_photo', {'caption': photo['text']},
+                                        ('photo', photo['path']), e)
+            error_message = await query.message.reply_text("Произошла ошибка при отправке фото. Пожалуйста, попробуйте позже.")
+            message_ids.append(error_message.message_id)  
 
     else:
         no_instructions_message = await query.message.reply_text("На данный момент у нас нет инструкций для выбранной платформы.")
@@ -196,143 +237,81 @@ async def switch_to_order_number(update: Update, context: CallbackContext) -> in
     await query.answer()
 
     await query.message.reply_text("Пожалуйста, введите номер вашего заказа.")
-    user_data[query.from_user.id]['stage'] = ORDER_NUMBER
+    sessions.update(query.from_user.id, stage=ORDER_NUMBER)
     return ORDER_NUMBER
 
 
-async def send_platform_photos(context: CallbackContext, query: Update, platform: str):
-    photos = photo_paths.get(platform, [])
-    if photos:
-        media_group = [InputMediaPhoto(open(photo, 'rb')) for photo in photos]
-        try:
-            messages_list = await context.bot.send_media_group(
-                chat_id=query.message.chat_id,
-                media=media_group
-            )
-            message_ids = [msg.message_id for msg in messages_list]
-            logger.info(f"Sent photos: {message_ids}")
-        except Exception as e:
-            logger.error(f"Error sending photos: {e}")
-            await query.message.reply_text("Произошла ошибка при отправке фото. Пожалуйста, попробуйте позже.")
-            return
+async def open_main_menu(update: Update, context: CallbackContext) -> int:
+    await update.callback_query.answer()
+    return await show_main_menu(update, context)
 
-        user_data[query.from_user.id]['instruction_message_ids'] = message_ids
-    else:
-        await query.message.reply_text("На данный момент у нас нет инструкций для выбранной платформы.")
-        logger.info("No instructions available for the chosen platform")
+async def open_personal_cabinet(update: Update, context: CallbackContext) -> int:
+    await update.callback_query.answer()
+    return await show_personal_cabinet(update, context)
 
-async def show_photos(context: CallbackContext, query: Update, platform: str):
-    photos = photo_paths.get(platform, [])
-    if photos:
-        media_group = [InputMediaPhoto(open(photo, 'rb')) for photo in photos]
-        try:
-            message_ids = user_data[query.from_user.id].get('instruction_message_ids', [])
-            for message_id in message_ids:
-                try:
-                    await context.bot.delete_message(chat_id=query.message.chat_id, message_id=message_id)
-                except Exception as e:
-                    logger.warning(f"Could not delete message {message_id}: {e}")
-
-            messages_list = await context.bot.send_media_group(
-                chat_id=query.message.chat_id,
-                media=media_group
-            )
-            message_ids = [msg.message_id for msg in messages_list]
-            logger.info(f"Sent photos: {message_ids}")
-        except Exception as e:
-            logger.error(f"Error sending photos: {e}")
-            await query.message.reply_text("Произошла ошибка при отправке фото. Пожалуйста, попробуйте позже.")
-            return
-
-        user_data[query.from_user.id]['instruction_message_ids'] = message_ids
-    else:
-        await query.message.reply_text("На данный момент у нас нет инструкций для выбранной платформы.")
+async def show_test_info(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    await query.answer()
+    await edit_message(
+        query.message,
+        text="Это тестовая информация.\n"
+             "Вы можете вернуться в главное меню.",
+        reply_markup=PERSONAL_CABINET_KEYBOARD
+    )
+    return MAIN_MENU
 
-    await query.message.reply_text(messages["order_number_prompt"])
-    logger.info("Displayed order number prompt")
+async def confirm_data(update: Update, context: CallbackContext) -> int:
+    await update.callback_query.answer()
+    logger.info("User confirmed data is correct", extra=SAMPLED)
+    return await show_main_menu(update, context)
 
-async def handle_callback_query(update: Update, context: CallbackContext) -> int:
+async def reject_data(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
-    user_id = query.from_user.id
     await query.answer()
+    logger.info("User requested to change data", extra=SAMPLED)
+    await edit_message(
+        query.message,
+        text="Какие данные вы хотите изменить?",
+        reply_markup=CHANGE_DATA_KEYBOARD
+    )
+    return FINAL
 
-    logger.info(f"Callback query data: {query.data}")
-
-    if query.data == "main_menu":
-        logger.info("Switching to main menu")
-        return await show_main_menu(update, context)  
-    elif query.data == "personal_cabinet":
-        logger.info("Switching to personal cabinet")
-        return await show_personal_cabinet(update, context)
-    elif query.data == "test_info":
-        logger.info("Displaying test info")
-        await query.message.edit_text(
-            text="Это тестовая информация.\n"
-                 "Вы можете вернуться в главное меню.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Главное меню", callback_data="main_menu")]
-            ])
-        )
-        return MAIN_MENU
-
-    elif query.data == "confirm_yes":
-        logger.info("User confirmed data is correct")
-        return await show_main_menu(update, context)
-    elif query.data == "confirm_no":
-        logger.info("User requested to change data")
-        await query.message.edit_text(
-            text="Какие данные вы хотите изменить?",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Имя", callback_data="change_name")],
-                [InlineKeyboardButton("Категория", callback_data="change_category")],
-                [InlineKeyboardButton("Площадка", callback_data="change_platform")],
-                [InlineKeyboardButton("Номер заказа", callback_data="change_order_number")],
-                [InlineKeyboardButton("Контакт", callback_data="change_contact")],
-                [InlineKeyboardButton("Email", callback_data="change_email")],
-                [InlineKeyboardButton("Дата рождения", callback_data="change_birthday")],
-                [InlineKeyboardButton("Назад", callback_data="personal_cabinet")]
-            ])
-        )
-        return FINAL
+async def _ask(update: Update, text: str):
+    """Отвечает на нажатие кнопки, если оно было, и задает вопрос в чат."""
+    if update.callback_query:
+        await update.callback_query.answer()
+    await update.effective_message.reply_text(text)
 
-    elif query.data.startswith('show_photos_'):
-        platform = query.data.split('_')[-1]
-        logger.info(f"Showing photos for platform: {platform}")
-        await show_photos(context, query, platform)
-        return PLATFORM
+async def change_name(update: Update, context: CallbackContext) -> int:
+    await _ask(update, "Введите новое имя:")
+    return NAME_REQUEST
 
-    else:
-        logger.info(f"Platform selected: {query.data}")
-        return await handle_platform_choice(update, context)
+async def change_category(update: Update, context: CallbackContext) -> int:
+    await _ask(update, "Введите новую категорию:")
+    return CONNECT
 
-async def handle_data_change(update: Update, context: CallbackContext) -> int:
-    user_id = update.message.from_user.id
-    change_request = update.message.text
+async def change_platform(update: Update, context: CallbackContext) -> int:
+    return await show_platforms(update, context)
 
-    if change_request == "Имя":
-        await update.message.reply_text("Введите новое имя:")
-        return NAME_REQUEST
-    elif change_request == "Категория":
-        await update.message.reply_text("Введите новую категорию:")
-        return CONNECT
-    elif change_request == "Площадка":
-        await show_platforms(update, context)
-        return PLATFORM
-    elif change_request == "Номер заказа":
-        await update.message.reply_text("Введите новый номер заказа:")
-        return ORDER_NUMBER
-    elif change_request == "Контакт":
-        await update.message.reply_text(messages["contact_request"])
-        return CONTACT
-    elif change_request == "Email":
-        await update.message.reply_text(messages["email_request"])
-        return EMAIL
-    elif change_request == "Дата рождения":
-        await update.message.reply_text(messages["birthday_request"])
-        return BIRTHDAY
-    else:
-        await update.message.reply_text("Некорректный выбор. Попробуйте еще раз.")
-        return FINAL
+async def change_order_number(update: Update, context: CallbackContext) -> int:
+    await _ask(update, "Введите новый номер заказа:")
+    return ORDER_NUMBER
+
+async def change_contact(update: Update, context: CallbackContext) -> int:
+    await _ask(update, messages["contact_request"])
+    return CONTACT
+
+async def change_email(update: Update, context: CallbackContext) -> int:
+    await _ask(update, messages["email_request"])
+    return EMAIL
+
+async def change_birthday(update: Update, context: CallbackContext) -> int:
+    await _ask(update, messages["birthday_request"])
+    return BIRTHDAY
+
+async def unknown_data_change(update: Update, context: CallbackContext) -> int:
+    await update.message.reply_text("Некорректный выбор. Попробуйте еще раз.")
+    return FINAL
 
 async def show_personal_cabinet(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
@@ -343,7 +322,7 @@ async def show_personal_cabinet(update: Update, context: CallbackContext) -> int
         user_id = update.message.from_user.id
         message = update.message
 
-    user_info = user_data.get(user_id, {})
+    user_info = sessions.get(user_id) or {}
 
     summary = (
         f"Имя: {user_info.get('name', 'Не указано')}\n"
@@ -355,82 +334,72 @@ async def show_personal_cabinet(update: Update, context: CallbackContext) -> int
         f"Дата рождения: {user_info.get('birthday', 'Не указана')}\n"
     )
 
-    # Обновление текста сообщения и кнопок
-    await message.edit_text(
+    await show_screen(
+        update, message,
         text=f"Ваши данные:\n{summary}",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Главное меню", callback_data="main_menu")]
-        ])
+        reply_markup=PERSONAL_CABINET_KEYBOARD
     )
 
-    user_data[user_id]['stage'] = PERSONAL_CABINET
+    sessions.update(user_id, stage=PERSONAL_CABINET)
     return PERSONAL_CABINET
 
 
 async def show_platforms(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    user_id = query.from_user.id
-    
-    if 'instruction_message_ids' in user_data[user_id]:
-        for message_id in user_data[user_id]['instruction_message_ids']:
-            try:
-                await context.bot.delete_message(chat_id=query.message.chat_id, message_id=message_id)
-            except Exception as e:
-                logger.warning(f"Could not delete message {message_id}: {e}")
-        user_data[user_id].pop('instruction_message_ids', None)
-
-    order_number_request_message_id = user_data[user_id].get('order_number_request_message_id')
-    if order_number_request_message_id:
-        try:
-            await context.bot.delete_message(chat_id=query.message.chat_id, message_id=order_number_request_message_id)
-        except Exception as e:
-            logger.warning(f"Could not delete message {order_number_request_message_id}: {e}")
+    if update.callback_query:
+        await update.callback_query.answer()
+    user_id = update.effective_user.id
+    message = update.effective_message
+    user_info = sessions.get(user_id)
+    if user_info is None:
+        # Кнопка из старого сообщения у пользователя без сессии: анкету начинает только /start
+        return None
+
+    instruction_message_ids = sessions.pop(user_id, 'instruction_message_ids') or []
+    order_number_request_message_id = user_info.get('order_number_request_message_id')
+    await delete_messages(
+        context.bot, message.chat_id,
+        instruction_message_ids + [order_number_request_message_id]
+    )
 
-    await query.message.reply_text(
+    await message.reply_text(
         "Выберите платформу, на которой приобретали нашу продукцию.",
-        reply_markup=generate_platform_buttons()
+        reply_markup=PLATFORM_KEYBOARD
     )
-    logger.info("Displayed platform options")
+    logger.info("Displayed platform options", extra=SAMPLED)
     return PLATFORM
 
-async def handle_stage(update: Update, context: CallbackContext) -> int:
-    user_id = update.message.from_user.id
-    stage = user_data[user_id].get('stage', CONNECT)
-
-    if stage == ORDER_NUMBER:
-        return await request_contact(update, context)
-    elif stage == CONTACT:
-        return await request_email(update, context)
-    elif stage == EMAIL:
-        return await request_birthday(update, context)
-    elif stage == BIRTHDAY:
-        return await handle_birthday(update, context)
-
 async def request_contact(update: Update, context: CallbackContext) -> int:
     user_id = update.message.from_user.id
-    user_data[user_id]['order_number'] = update.message.text
-    await update.message.reply_text(messages["contact_request"])
-    await asyncio.sleep(2)
+    chat_id = update.effective_chat.id
+    platform = sessions.get(user_id).get('platform')
+    order_number = normalize_order_number(update.message.text)
+    if not await order_index.claim(platform, order_number, user_id):
+        logger.info("Duplicate order number %s on %s from user %s", order_number, platform, user_id)
+        await update.message.reply_text(DUPLICATE_ORDER_MESSAGE)
+        return ORDER_NUMBER
+
+    sessions.update(user_id, order_number=order_number)
+    outbox.submit(chat_id, 'send_message', paced=True, text=messages["contact_request"])
     
-    contact_button = KeyboardButton("Поделиться контактом", request_contact=True)
-    await update.message.reply_text(
-        messages["contact_button"], 
-        reply_markup=ReplyKeyboardMarkup([[contact_button]], one_time_keyboard=True, resize_keyboard=True)
+    outbox.submit(
+        chat_id, 'send_message',
+        text=messages["contact_button"], 
+        reply_markup=CONTACT_KEYBOARD
     )
     
-    user_data[user_id]['stage'] = CONTACT
+    sessions.update(user_id, stage=CONTACT)
     return CONTACT
 
 async def request_email(update: Update, context: CallbackContext) -> int:
     if update.message.contact:
         user_id = update.message.from_user.id
-        user_data[user_id]['contact'] = update.message.contact.phone_number
+        sessions.update(user_id, contact=update.message.contact.phone_number)
 
         await update.message.reply_text(
             messages["email_request"],
-            reply_markup=ReplyKeyboardMarkup([['Пропустить']], one_time_keyboard=True, resize_keyboard=True)
+            reply_markup=EMAIL_KEYBOARD
         )
-        user_data[user_id]['stage'] = EMAIL
+        sessions.update(user_id, stage=EMAIL)
         return EMAIL
     
     await update.message.reply_text("Пожалуйста, используйте кнопку 'Поделиться контактом' для отправки номера телефона.")
@@ -439,37 +408,23 @@ async def request_email(update: Update, context: CallbackContext) -> int:
 async def request_birthday(update: Update, context: CallbackContext) -> int:
     user_id = update.message.from_user.id
     if update.message.text.lower() == 'пропустить':
-        user_data[user_id]['email'] = 'Не указано'
+        sessions.update(user_id, email='Не указано')
     else:
-        email = update.message.text
-        if re.match(r"[^@]+@[^@]+\.[^@]+", email):
-            user_data[user_id]['email'] = email
-        else:
-            await update.message.reply_text("Некорректный email адрес. Пожалуйста, введите корректный адрес электронной почты или нажмите 'Пропустить'.")
-            return EMAIL
-
-    await update.message.reply_text(messages["birthday_request"], reply_markup=ReplyKeyboardRemove())
-    user_data[user_id]['stage'] = BIRTHDAY
+        sessions.update(user_id, email=update.message.text)
+
+    await update.message.reply_text(messages["birthday_request"], reply_markup=REMOVE_KEYBOARD)
+    sessions.update(user_id, stage=BIRTHDAY)
     return BIRTHDAY
 
 async def handle_birthday(update: Update, context: CallbackContext) -> int:
     user_id = update.message.from_user.id
-    birthday = update.message.text
-    try:
-        day, month, year = map(int, birthday.split('.'))
-        if 1 <= day <= 31 and 1 <= month <= 12 and 1900 <= year <= 2100:
-            user_data[user_id]['birthday'] = birthday
-            await confirm_user_data(update, context)
-            return FINAL
-        else:
-            raise ValueError
-    except ValueError:
-        await update.message.reply_text("Некорректная дата. Пожалуйста, введите дату в формате ДД.ММ.ГГГГ.")
-        return BIRTHDAY
+    sessions.update(user_id, birthday=update.message.text)
+    await confirm_user_data(update, context)
+    return FINAL
 
 async def confirm_user_data(update: Update, context: CallbackContext) -> int:
     user_id = update.message.from_user.id
-    user_info = user_data[user_id]
+    user_info = sessions.get(user_id)
     
     summary = (
         f"Имя: {user_info['name']}\n"
@@ -482,20 +437,15 @@ async def confirm_user_data(update: Update, context: CallbackContext) -> int:
     )
     await update.message.reply_text(
         f"Ваша информация:\n{summary}\nВсе ли данные верны?",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Да", callback_data="confirm_yes")],
-            [InlineKeyboardButton("Нет", callback_data="confirm_no")]
-        ])
+        reply_markup=CONFIRMATION_KEYBOARD
     )
     return FINAL
 
-def error_handler(update: Update, context: CallbackContext) -> None:
+async def error_handler(update: Update, context: CallbackContext) -> None:
     logger.warning('Update "%s" caused error "%s"', update, context.error)
-    if isinstance(context.error, Exception):
+    if isinstance(context.error, Exception) and isinstance(update, Update) and update.effective_chat:
+        # Ответ идет через outbox: он ограничен очередью чата и не теряется при остановке бота
         try:
-            if update and update.message:
-                asyncio.create_task(update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте позже."))
-            elif update and update.callback_query:
-                asyncio.create_task(update.callback_query.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте позже."))
+            outbox.submit(update.effective_chat.id, 'send_message', text="Произошла ошибка. Пожалуйста, попробуйте позже.")
         except Exception as e:
-            logger.error(f"Error sending error message: {e}")
\ No newline at end of file
+            logger.error("Error sending error message: %s", e)
\ No newline at end of file
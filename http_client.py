@@ -0,0 +1,73 @@
+"""HTTP-клиент для вызовов Bot API.
+
+Запросы идут по двум каналам с отдельными пулами соединений: короткие JSON-вызовы
+(answerCallbackQuery, sendMessage, deleteMessage) и загрузки файлов. Загрузка пачки
+фото занимает соединения на секунды, и в общем пуле ответы на нажатия кнопок ждали бы
+своей очереди за ней.
+"""
+import logging
+
+import httpx
+from telegram.request import BaseRequest
+
+from metrics import InstrumentedRequest
+
+logger = logging.getLogger(__name__)
+
+
+class PooledRequest(InstrumentedRequest):
+    """InstrumentedRequest с настраиваемым временем жизни простаивающих соединений."""
+
+    def __init__(self, connection_pool_size: int = 1, keepalive_expiry: float = 5.0, **kwargs):
+        self._pool_size = connection_pool_size
+        self._keepalive_expiry = keepalive_expiry
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        # HTTPXRequest в python-telegram-bot 21.4 не дает задать keepalive_expiry, и лимиты пула
+        # подменяются в его закрытом _client_kwargs. Если в другой версии его нет, остается пул PTB
+        client_kwargs = getattr(self, '_client_kwargs', None)
+        if not isinstance(client_kwargs, dict) or 'limits' not in client_kwargs:
+            logger.warning("HTTPXRequest has no _client_kwargs['limits'], keepalive_expiry=%s is ignored",
+                           self._keepalive_expiry)
+            return super()._build_client()
+        client_kwargs['limits'] = httpx.Limits(
+            max_connections=self._pool_size,
+            max_keepalive_connections=self._pool_size,
+            keepalive_expiry=self._keepalive_expiry
+        )
+        return super()._build_client()
+
+
+class ChannelRequest(BaseRequest):
+    """Запросы с файлами и скачивание файлов идут в канал uploads, остальные — в канал api."""
+
+    def __init__(self, api: BaseRequest, uploads: BaseRequest):
+        self.api = api
+        self.uploads = uploads
+
+    def channel(self, request_data=None) -> BaseRequest:
+        if request_data is not None and request_data.contains_files:
+            return self.uploads
+        return self.api
+
+    @property
+    def read_timeout(self):
+        return self.api.read_timeout
+
+    async def initialize(self):
+        await self.api.initialize()
+        await self.uploads.initialize()
+
+    async def shutdown(self):
+        await self.api.shutdown()
+        await self.uploads.shutdown()
+
+    async def post(self, url, request_data=None, *args, **kwargs):
+        return await self.channel(request_data).post(url, request_data, *args, **kwargs)
+
+    async def retrieve(self, url, *args, **kwargs):
+        return await self.uploads.retrieve(url, *args, **kwargs)
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        return await self.channel(request_data).do_request(url, method, request_data, *args, **kwargs)
@@ -0,0 +1,195 @@
+"""Подготовка скриншотов инструкций к отправке в Telegram.
+
+    python images.py            # оптимизировать фото из config.photo_paths
+    python images.py --force    # перекодировать заново
+
+Каждое изображение уменьшается до предела, в котором Telegram показывает фото, и
+перекодируется в JPEG или PNG — что окажется меньше. Имя результата — хеш исходных байтов
+и настроек, поэтому одинаковые картинки сжимаются и загружаются один раз, а неизменившиеся
+не перекодируются при следующем запуске, если не поменялись и настройки сжатия.
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+OPTIMIZED_DIR = 'photo/optimized'
+MANIFEST_NAME = 'manifest.json'
+# Telegram показывает фото не больше 1280 px по длинной стороне, большие он все равно пережимает
+MAX_SIDE = 1280
+JPEG_QUALITY = 85
+SETTINGS = f"{MAX_SIDE}|{JPEG_QUALITY}"
+
+
+def _digest(path: str) -> str:
+    hasher = hashlib.sha256(SETTINGS.encode())
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 16), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()[:16]
+
+
+def encode(image: Image.Image) -> tuple:
+    """Возвращает (расширение, байты) для меньшего из вариантов JPEG и PNG."""
+    if max(image.size) > MAX_SIDE:
+        image = image.copy()
+        image.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+
+    if image.mode in ('RGBA', 'LA', 'P'):
+        rgba = image.convert('RGBA')
+        flat = Image.new('RGB', rgba.size, 'white')
+        flat.paste(rgba, mask=rgba.getchannel('A'))
+    else:
+        flat = image.convert('RGB')
+
+    candidates = []
+    buffer = io.BytesIO()
+    flat.save(buffer, format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    candidates.append(('jpg', buffer.getvalue()))
+    buffer = io.BytesIO()
+    flat.save(buffer, format='PNG', optimize=True)
+    candidates.append(('png', buffer.getvalue()))
+    return min(candidates, key=lambda candidate: len(candidate[1]))
+
+
+def _optimize_file(job) -> tuple:
+    source, digest, out_dir = job
+    with Image.open(source) as image:
+        ext, data = encode(image)
+    path = os.path.join(out_dir, f"{digest}.{ext}")
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+    return digest, path
+
+
+class ImageOptimizer:
+    """Манифест исходный путь -> оптимизированный файл, хранится рядом с результатами."""
+
+    def __init__(self, out_dir: str = OPTIMIZED_DIR):
+        self.out_dir = out_dir
+        self.manifest = {}
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.out_dir, MANIFEST_NAME)
+
+    def _load(self):
+        try:
+            with open(self.manifest_path, encoding='utf-8') as file:
+                self.manifest = json.load(file)
+        except (FileNotFoundError, ValueError):
+            self.manifest = {}
+
+    def _save(self):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.manifest, file, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _is_fresh(self, source: str, stat) -> bool:
+        entry = self.manifest.get(source)
+        return (
+            entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size
+            and entry.get('settings') == SETTINGS and os.path.exists(entry['path'])
+        )
+
+    def optimize(self, sources, force: bool = False, workers: int = None) -> dict:
+        """Оптимизирует изображения и возвращает исходный путь -> путь к оптимизированному файлу."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        self._load()
+        digests = {}
+        jobs = {}
+        for source in dict.fromkeys(sources):
+            stat = os.stat(source)
+            if not force and self._is_fresh(source, stat):
+                continue
+            digest = _digest(source)
+            digests[source] = (digest, stat)
+            jobs.setdefault(digest, (source, digest, self.out_dir))
+
+        outputs = {}
+        if len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                outputs = dict(pool.map(_optimize_file, jobs.values()))
+        elif jobs:
+            outputs = dict(map(_optimize_file, jobs.values()))
+
+        saved = 0
+        for source, (digest, stat) in digests.items():
+            path = outputs[digest]
+            if os.path.getsize(path) >= stat.st_size:
+                # Уже сжатый файл перекодирование только увеличит
+                path = source
+            self.manifest[source] = {'path': path, 'mtime': stat.st_mtime, 'size': stat.st_size, 'settings': SETTINGS}
+            saved += stat.st_size - os.path.getsize(path)
+        if digests:
+            self._save()
+        logger.info(
+            "Images: %s changed, %s encoded, %s duplicates, %s up to date, %s KB saved",
+            len(digests), len(jobs), len(digests) - len(jobs), len(self.manifest) - len(digests), saved // 1024
+        )
+        return {source: entry['path'] for source, entry in self.manifest.items()}
+
+    def resolve(self, path: str) -> str:
+        entry = self.manifest.get(path)
+        return entry['path'] if entry else path
+
+
+def photo_sources(photo_paths: dict) -> list:
+    return [photo.get('source', photo['path']) for photos in photo_paths.values() for photo in photos]
+
+
+def use_optimized(photo_paths: dict, out_dir: str = OPTIMIZED_DIR, workers: int = None) -> int:
+    """Оптимизирует фото инструкций и подменяет пути в photo_paths на оптимизированные.
+
+    Исходный путь сохраняется в поле 'source', поэтому повторный вызов ничего не ломает.
+    Если какое-то фото не удалось обработать, для него остается исходный файл.
+    """
+    for photos in photo_paths.values():
+        for photo in photos:
+            photo.setdefault('source', photo['path'])
+
+    optimizer = ImageOptimizer(out_dir)
+    try:
+        optimizer.optimize(photo_sources(photo_paths), workers=workers)
+    except Exception as e:
+        logger.error("Could not optimize instruction photos, sending originals: %s", e)
+
+    replaced = 0
+    for photos in photo_paths.values():
+        for photo in photos:
+            photo['path'] = optimizer.resolve(photo['source'])
+            replaced += photo['path'] != photo['source']
+    return replaced
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resize and re-encode instruction photos")
+    parser.add_argument('paths', nargs='*', help="images to optimize; defaults to config.photo_paths")
+    parser.add_argument('--out', default=OPTIMIZED_DIR)
+    parser.add_argument('--force', action='store_true', help="re-encode even up-to-date images")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if args.paths:
+        sources = args.paths
+    else:
+        from config import photo_paths
+        sources = photo_sources(photo_paths)
+    optimized = ImageOptimizer(args.out).optimize(sources, args.force, args.workers)
+    for source in sources:
+        print(f"{source}: {os.path.getsize(source)} -> {optimized[source]}: {os.path.getsize(optimized[source])}")
+
+
+if __name__ == '__main__':
+    main()
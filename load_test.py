@@ -0,0 +1,393 @@
+"""Прогоняет виртуальных пользователей через всю анкету бота на локальном fake Bot API.
+
+    python load_test.py --users 2000 --concurrency 200 --latency 0.05 --rate-limit-prob 0.01
+    python load_test.py --users 2000 --workers 4 --latency 0.05
+    python load_test.py --users 200 --webhook
+
+Апдейты подаются в Application так же, как их подает polling, поэтому работают все обработчики,
+ConversationHandler и PerUserUpdateProcessor. Для каждого состояния выводятся p50/p95/p99.
+
+С --workers бот запускается в режиме нескольких процессов: апдейты отдает getUpdates fake Bot API,
+диспетчер раздает их рабочим процессам, сессии лежат во временной SQLite-базе. Задержки по
+состояниям в этом режиме не измеряются, выводится общее время и пропускная способность.
+
+С --webhook бот запускается отдельным процессом с BOT_MODE=webhook. fake Bot API запоминает
+адрес и секрет из setWebhook и доставляет апдейты POST-запросами с заголовком секрета. Сначала
+проверяется, что апдейт с неверным секретом бот отвергает, и только после этого идет прогон.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from fake_bot_api import FakeBotApi
+
+logger = logging.getLogger(__name__)
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": "Иван", "language_code": "ru"}
+
+
+def _chat(user_id: int) -> dict:
+    return {"id": user_id, "type": "private", "first_name": "Иван"}
+
+
+def message_update(user_id: int, text: str = None, contact: dict = None) -> dict:
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": _chat(user_id),
+        "from": _user(user_id),
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if contact is not None:
+        message["contact"] = contact
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def callback_update(user_id: int, data: str, message_id: int = None) -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id or next(_message_ids),
+                "date": int(time.time()),
+                "chat": _chat(user_id),
+                "text": "...",
+            },
+        },
+    }
+
+
+def sample_order_number(platform: str, user_id: int) -> str:
+    """Уникальный для пользователя номер заказа в формате площадки."""
+    if platform == "Ozon":
+        return f"{user_id % 10 ** 8:08d}-{user_id // 10 ** 8 % 10 ** 4:04d}"
+    return f"{10 ** 9 + user_id}"
+
+
+def funnel_script(user_id: int, category: str, platform: str) -> list:
+    """Шаги анкеты: (название состояния, апдейт)."""
+    return [
+        ("START", message_update(user_id, f"/start {category}")),
+        ("CONNECT", message_update(user_id, "Подключиться")),
+        ("CONSENT", callback_update(user_id, "accept")),
+        ("PLATFORM", callback_update(user_id, platform)),
+        ("ORDER_NUMBER_PROMPT", callback_update(user_id, "switch_state_to_order")),
+        ("ORDER_NUMBER", message_update(user_id, sample_order_number(platform, user_id))),
+        ("CONTACT", message_update(user_id, contact={
+            "phone_number": f"+7900{user_id % 10 ** 7:07d}", "first_name": "Иван", "user_id": user_id
+        })),
+        ("EMAIL", message_update(user_id, f"user{user_id}@example.com")),
+        ("BIRTHDAY", message_update(user_id, "01.01.1990")),
+        ("FINAL", callback_update(user_id, "confirm_yes")),
+    ]
+
+
+CATEGORIES = ["bed_linen", "towel", "blanket"]
+PLATFORMS = ["Ozon", "Wildberries", "Мегамаркет", "ЯндексМаркет"]
+
+
+def user_funnel(user_id: int, index: int) -> list:
+    """Шаги анкеты index-го виртуального пользователя; категории и площадки идут по кругу."""
+    return funnel_script(user_id, CATEGORIES[index % len(CATEGORIES)], PLATFORMS[index % len(PLATFORMS)])
+
+
+def interleaved_updates(first_user_id: int, users: int) -> list:
+    """Апдейты анкет всех пользователей; шаги чередуются, как при одновременном прохождении анкеты."""
+    scripts = [user_funnel(first_user_id + index, index) for index in range(users)]
+    return [script[step][1] for step in range(len(scripts[0])) for script in scripts]
+
+
+def wait_completed(api: FakeBotApi, users: int, timeout: float) -> int:
+    """Ждет, пока users пользователей пройдут анкету, и возвращает, сколько прошло.
+
+    Последний шаг анкеты заканчивается редактированием сообщения главного меню.
+    """
+    deadline = time.monotonic() + timeout
+    while api.stats()["calls"].get("editMessageText", 0) < users and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return api.stats()["calls"].get("editMessageText", 0)
+
+
+MENU_TAPS = ("personal_cabinet", "personal_cabinet", "main_menu", "main_menu")
+
+
+def menu_script(user_id: int, final_update: dict, taps: int) -> list:
+    """Нажатия кнопок меню в сообщении, которое показал последний шаг анкеты; каждое второе повторяет предыдущее."""
+    message_id = final_update["callback_query"]["message"]["message_id"]
+    return [("MENU", callback_update(user_id, MENU_TAPS[i % len(MENU_TAPS)], message_id)) for i in range(taps)]
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run(args) -> dict:
+    from telegram import Update
+    from main import build_application, configure_services, on_startup, on_stop, on_shutdown
+
+    # file_id от fake Bot API не должны попасть в настоящий кеш, а недоставленные сообщения — в настоящий журнал
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    os.environ["ASSET_CACHE_FILE"] = os.path.join(workdir, "asset_cache.json")
+    os.environ["DEAD_LETTER_FILE"] = os.path.join(workdir, "dead_letters.jsonl")
+
+    api = FakeBotApi(latency=args.latency, jitter=args.jitter, rate_limit_prob=args.rate_limit_prob).start()
+    os.environ.setdefault("SESSION_BACKEND", "memory")
+    os.environ["MESSAGE_PACE"] = str(args.pace)
+    os.environ["OUTBOX_GLOBAL_RATE"] = str(args.global_rate)
+    os.environ["OUTBOX_CHAT_RATE"] = str(args.chat_rate)
+    configure_services()
+    application = build_application("123456:LOADTEST", api.url)
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def virtual_user(index: int):
+        user_id = args.first_user_id + index
+        script = user_funnel(user_id, index)
+        script += menu_script(user_id, script[-1][1], args.menu_taps)
+        async with semaphore:
+            for state, data in script:
+                update = Update.de_json(data, application.bot)
+                started = time.perf_counter()
+                try:
+                    await application.update_processor.process_update(update, application.process_update(update))
+                except Exception as e:
+                    errors[state] += 1
+                    logger.debug("Update for user %s in %s failed: %s", user_id, state, e)
+                latencies[state].append(time.perf_counter() - started)
+                if args.think_time:
+                    await asyncio.sleep(args.think_time)
+
+    async with application:
+        await on_startup(application)
+        started = time.perf_counter()
+        await asyncio.gather(*(virtual_user(i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+        await on_stop(application)
+        await on_shutdown(application)
+
+    api.stop()
+
+    total_updates = sum(len(values) for values in latencies.values())
+    report = {
+        "users": args.users,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(total_updates / elapsed, 1) if elapsed else 0.0,
+        "users_per_s": round(args.users / elapsed, 1) if elapsed else 0.0,
+        "states": {},
+        "api": api.stats(),
+    }
+    for state in [state for state, _ in funnel_script(0, "", "")] + ["MENU"] * bool(args.menu_taps):
+        values = sorted(latencies[state])
+        report["states"][state] = {
+            "count": len(values),
+            "errors": errors[state],
+            "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        }
+    return report
+
+
+def run_sharded(args) -> dict:
+    from main import prepare_assets
+    from sharding import Dispatcher
+
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    # Рабочие процессы читают настройки из окружения при запуске
+    os.environ.update({
+        "SESSION_BACKEND": "sqlite",
+        "SESSION_DB": os.path.join(workdir, "sessions.db"),
+        "ASSET_CACHE_FILE": os.path.join(workdir, "asset_cache.json"),
+        "DEAD_LETTER_FILE": os.path.join(workdir, "dead_letters.jsonl"),
+        "MESSAGE_PACE": str(args.pace),
+        "OUTBOX_GLOBAL_RATE": str(args.global_rate),
+        "OUTBOX_CHAT_RATE": str(args.chat_rate),
+        "LOG_LEVEL": "WARNING",
+        "LOG_FORMAT": "text",
+        "LOG_FILE": "",
+        "METRICS_PORT": "0",
+    })
+    prepare_assets()
+
+    api = FakeBotApi(latency=args.latency, jitter=args.jitter, rate_limit_prob=args.rate_limit_prob).start()
+    updates = interleaved_updates(args.first_user_id, args.users)
+    # getUpdates подтверждает апдейты по offset, поэтому update_id должны возрастать в порядке очереди
+    for update_id, update in enumerate(updates, 1):
+        update["update_id"] = update_id
+
+    dispatcher = Dispatcher("123456:LOADTEST", args.workers, api.url, poll_timeout=1)
+    dispatcher.start()
+    poller = threading.Thread(target=dispatcher.poll, name="dispatcher", daemon=True)
+    poller.start()
+
+    started = time.perf_counter()
+    api.push_updates(updates)
+    completed = wait_completed(api, args.users, args.timeout)
+    elapsed = time.perf_counter() - started
+
+    dispatcher.stop()
+    poller.join(timeout=5)
+    api.stop()
+    return {
+        "users": args.users,
+        "workers": args.workers,
+        "completed": completed,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(len(updates) / elapsed, 1) if elapsed else 0.0,
+        "users_per_s": round(completed / elapsed, 1) if elapsed else 0.0,
+        "states": {},
+        "api": api.stats(),
+    }
+
+
+def free_port(host: str = "127.0.0.1") -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def run_webhook(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    secret = os.urandom(16).hex()
+    env = dict(
+        os.environ,
+        BOT_MODE="webhook",
+        TOKEN_BOT="123456:LOADTEST",
+        WEBHOOK_LISTEN="127.0.0.1",
+        WEBHOOK_PORT=str(free_port()),
+        WEBHOOK_SECRET=secret,
+        SESSION_BACKEND="sqlite",
+        SESSION_DB=os.path.join(workdir, "sessions.db"),
+        ASSET_CACHE_FILE=os.path.join(workdir, "asset_cache.json"),
+        DEAD_LETTER_FILE=os.path.join(workdir, "dead_letters.jsonl"),
+        MESSAGE_PACE=str(args.pace),
+        OUTBOX_GLOBAL_RATE=str(args.global_rate),
+        OUTBOX_CHAT_RATE=str(args.chat_rate),
+        LOG_LEVEL="WARNING",
+        LOG_FORMAT="text",
+        LOG_FILE="",
+        METRICS_PORT="0",
+    )
+    env.pop("WEBHOOK_URL", None)
+
+    api = FakeBotApi(latency=args.latency, jitter=args.jitter, rate_limit_prob=args.rate_limit_prob).start()
+    env["BOT_API_URL"] = api.url
+    bot = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")],
+                           env=env)
+    try:
+        if not api.wait_for_webhook(args.timeout):
+            raise RuntimeError("The bot did not call setWebhook")
+        # PTB вызывает setWebhook до того, как сервер webhook начнет слушать порт
+        if not api.wait_for_listener(args.timeout):
+            raise RuntimeError(f"Nothing is listening on {api.webhook_url}")
+        # Апдейт с чужим секретом бот должен отвергнуть, не обработав
+        probe = message_update(args.first_user_id - 1, "/start")
+        rejected = api.deliver(probe, secret_token="wrong-" + secret)
+        if rejected != 403:
+            raise RuntimeError(f"Webhook did not reject a wrong secret token: HTTP {rejected}")
+        if api.deliver(probe, secret_token="") != 403:
+            raise RuntimeError("Webhook accepted an update without a secret token")
+
+        updates = interleaved_updates(args.first_user_id, args.users)
+        started = time.perf_counter()
+        failed = sum(api.deliver(update) != 200 for update in updates)
+        completed = wait_completed(api, args.users, args.timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        api.stop()
+    return {
+        "users": args.users,
+        "webhook": api.webhook_url,
+        "completed": completed,
+        "failed_deliveries": failed,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(len(updates) / elapsed, 1) if elapsed else 0.0,
+        "users_per_s": round(completed / elapsed, 1) if elapsed else 0.0,
+        "states": {},
+        "api": api.stats(),
+    }
+
+
+def print_report(report: dict):
+    print(f"{report['users']} users in {report['elapsed_s']} s: "
+          f"{report['updates_per_s']} updates/s, {report['users_per_s']} users/s")
+    if "workers" in report:
+        print(f"{report['workers']} workers, {report['completed']} users completed")
+    if "webhook" in report:
+        print(f"webhook {report['webhook']}: wrong secret rejected, {report['failed_deliveries']} updates not accepted, "
+              f"{report['completed']} users completed")
+    print(f"{'state':<22}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for state, row in report["states"].items():
+        print(f"{state:<22}{row['count']:>8}{row['errors']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    print(f"API calls: {report['api']['calls']}")
+    if report["api"]["rate_limited"]:
+        print(f"429 injected: {report['api']['rate_limited']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Onboarding funnel load test against a fake Bot API")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100, help="virtual users active at once")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake Bot API delay per call, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0)
+    parser.add_argument("--think-time", type=float, default=0.0, help="pause between a user's steps, seconds")
+    parser.add_argument("--pace", type=float, default=0.0, help="MESSAGE_PACE for the outbox")
+    parser.add_argument("--global-rate", type=float, default=30, help="OUTBOX_GLOBAL_RATE for the outbox")
+    parser.add_argument("--chat-rate", type=float, default=1, help="OUTBOX_CHAT_RATE for the outbox")
+    parser.add_argument("--menu-taps", type=int, default=0, help="menu button taps after the questionnaire")
+    parser.add_argument("--first-user-id", type=int, default=10 ** 9)
+    parser.add_argument("--workers", type=int, default=0, help="run sharded with this many worker processes")
+    parser.add_argument("--webhook", action="store_true", help="run the bot with BOT_MODE=webhook in a subprocess")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="sharded and webhook modes: give up after this many seconds")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    if args.webhook:
+        report = run_webhook(args)
+    elif args.workers:
+        report = run_sharded(args)
+    else:
+        report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+log_user_id = ContextVar('log_user_id', default=None)
+log_state = ContextVar('log_state', default=None)
+log_update_id = ContextVar('log_update_id', default=None)
+
+# Передается в extra= для частых info-событий, которые можно прореживать
+SAMPLED = {'sampled': True}
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи user_id, state и update_id текущего апдейта."""
+
+    def filter(self, record):
+        record.user_id = log_user_id.get()
+        record.state = log_state.get()
+        record.update_id = log_update_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю rate записей, помеченных SAMPLED. Предупреждения и ошибки не прореживаются."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if self.rate >= 1 or record.levelno > logging.INFO or not getattr(record, 'sampled', False):
+            return True
+        return random.random() < self.rate
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Кладет запись в очередь, подставив аргументы в сообщение; JSON и вывод собираются в потоке слушателя.
+
+    Аргументы подставляются сразу: аргумент вроде сессии или списка может измениться, пока запись
+    ждет в очереди, и в лог попало бы уже новое значение.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'user_id': getattr(record, 'user_id', None),
+            'state': getattr(record, 'state', None),
+            'update_id': getattr(record, 'update_id', None),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def setup_logging(level: str = 'INFO', log_format: str = 'json', log_file: str = None, sample_rate: float = 1.0):
+    """Переносит запись логов в отдельный поток через очередь и возвращает запущенный QueueListener."""
+    formatter = JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+    # Логи httpx о каждом запросе к Bot API дублируют метрики
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -3,58 +3,227 @@
 import logging
 import os
 from dotenv import load_dotenv
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, filters
-from handlers import (
-    handle_data_change, start, request_name, send_intro_message, handle_consent, 
-    handle_platform_choice, handle_stage, handle_callback_query, error_handler, 
-    show_main_menu, show_personal_cabinet, switch_to_order_number, show_platforms
-)
-from config import CONNECT, NAME_REQUEST, CONSENT, PLATFORM, ORDER_NUMBER, CONTACT, EMAIL, BIRTHDAY, FINAL, MAIN_MENU, PERSONAL_CABINET, ORDER_NUMBER_PROMPT
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+from telegram.ext import ApplicationBuilder, CommandHandler
+from handlers import error_handler
+from conversation import FLOW
+from storage import sessions, create_backend
+from orders import order_index
+from funnel import funnel
+from memory_report import memory_report, SNAPSHOT_DIR
+from outbox import outbox
+from dead_letters import dead_letters, DEAD_LETTER_FILE
+from qr_codes import load_campaigns
+from images import use_optimized
+from asset_cache import asset_cache, ASSET_CACHE_FILE
+from sharding import run_sharded
+from broadcast import Broadcast, resume_active_broadcast
+from admin import (
+    broadcast_command, broadcast_status_command, export_command, dead_letters_command, funnel_command, memory_command,
+    qr_command
 )
+from update_processor import PerUserUpdateProcessor
+from logging_setup import setup_logging
+from metrics import metrics_server, timed
+from http_client import ChannelRequest, PooledRequest
+from retry import RetryLimiter
+from config import photo_paths
 
 logger = logging.getLogger(__name__)
 
-def main() -> None:
-    load_dotenv()
-    
-    application = ApplicationBuilder().token(os.getenv("TOKEN_BOT")).build()
-    
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
-        states={
-            CONNECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_intro_message)],
-            NAME_REQUEST: [MessageHandler(filters.TEXT & ~filters.COMMAND, request_name)],
-            CONSENT: [CallbackQueryHandler(handle_consent)],
-            PLATFORM: [CallbackQueryHandler(handle_platform_choice)],
-            ORDER_NUMBER_PROMPT: [CallbackQueryHandler(switch_to_order_number, pattern='^switch_state_to_order$'), CallbackQueryHandler(show_platforms, pattern='^choose_platform$')],
-            ORDER_NUMBER: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_stage)],
-            CONTACT: [MessageHandler(filters.CONTACT, handle_stage)],
-            EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_stage)],
-            BIRTHDAY: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_stage)],
-            FINAL: [
-                CallbackQueryHandler(handle_callback_query, pattern='^confirm_yes$|^confirm_no$|^main_menu$|^personal_cabinet$'),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_data_change)
-            ],
-            MAIN_MENU: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, show_main_menu),
-                CallbackQueryHandler(handle_callback_query, pattern='^personal_cabinet$|^main_menu$')
-            ],
-            PERSONAL_CABINET: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, show_personal_cabinet),
-                CallbackQueryHandler(handle_callback_query, pattern='^main_menu$')
-            ],
-        },
-        fallbacks=[CommandHandler('start', start)],
+async def on_startup(application) -> None:
+    await sessions.start()
+    sessions.add_flush_hook(order_index.flush)
+    funnel.start(sessions)
+    sessions.add_flush_hook(funnel.flush)
+    await order_index.load(sessions)
+    outbox.start(application.bot)
+    application.bot_data['broadcast'] = Broadcast(
+        application.bot,
+        rate=float(os.getenv("BROADCAST_RATE", "20")),
+        reserve=float(os.getenv("BROADCAST_RESERVE", "10"))
+    )
+    shard_index = application.bot_data.get('shard_index', 0)
+    # Прерванную рассылку продолжает только один процесс
+    if shard_index == 0:
+        await resume_active_broadcast(application.bot_data['broadcast'])
+    metrics_port = int(os.getenv("METRICS_PORT", "0"))
+    if metrics_port:
+        metrics_server.add_route('/memory', 'text/plain', lambda: memory_report.report(application))
+        metrics_server.add_route('/memory/snapshot', 'text/plain', memory_report.snapshot)
+        await metrics_server.start(os.getenv("METRICS_HOST", "127.0.0.1"), metrics_port + shard_index)
+
+async def on_stop(application) -> None:
+    # Очередь исходящих дописывается, пока HTTP-клиенты бота еще открыты: post_shutdown
+    # вызывается уже после их закрытия
+    await application.bot_data['broadcast'].stop()
+    await metrics_server.close()
+    await outbox.close()
+
+async def on_shutdown(application) -> None:
+    await sessions.close()
+
+def prepare_assets() -> None:
+    if os.getenv("OPTIMIZE_PHOTOS", "1") == "1":
+        use_optimized(photo_paths)
+
+def configure_services(shard_count: int = 1, shard_index: int = 0) -> None:
+    """Настраивает общие сервисы из окружения. При shard_count > 1 лимиты делятся между процессами."""
+    asset_cache_file = os.getenv("ASSET_CACHE_FILE", ASSET_CACHE_FILE)
+    if shard_count > 1:
+        # Каждый процесс переписывает файл своими file_id, поэтому файл у каждого свой
+        root, ext = os.path.splitext(asset_cache_file)
+        asset_cache_file = f"{root}.{shard_index}{ext}"
+    asset_cache.configure(asset_cache_file)
+    sessions.configure(
+        create_backend(os.getenv("SESSION_BACKEND", "sqlite"), os.getenv("SESSION_DB", "sessions.db")),
+        flush_interval=float(os.getenv("SESSION_FLUSH_INTERVAL", "1.0")),
+        batch_size=int(os.getenv("SESSION_BATCH_SIZE", "500")),
+        ttl=float(os.getenv("SESSION_TTL", "3600")),
+        memory_budget=int(float(os.getenv("SESSION_MEMORY_MB", "64")) * 1024 * 1024)
+    )
+    order_index.shared = shard_count > 1
+    outbox.configure(
+        global_rate=float(os.getenv("OUTBOX_GLOBAL_RATE", "30")) / shard_count,
+        chat_rate=float(os.getenv("OUTBOX_CHAT_RATE", "1")),
+        chat_burst=float(os.getenv("OUTBOX_CHAT_BURST", "3")),
+        pace=float(os.getenv("MESSAGE_PACE", "2")),
+        max_pending=int(os.getenv("OUTBOX_MAX_PENDING", "100"))
+    )
+    dead_letters.configure(os.getenv("DEAD_LETTER_FILE", DEAD_LETTER_FILE))
+    memory_report.configure(
+        os.getenv("MEMORY_SNAPSHOT_DIR", SNAPSHOT_DIR),
+        frames=int(os.getenv("MEMORY_TRACE_FRAMES", "0"))
+    )
+    prepare_assets()
+    campaigns_file = os.getenv("QR_CAMPAIGNS_FILE")
+    if campaigns_file:
+        load_campaigns(campaigns_file)
+
+def build_request() -> ChannelRequest:
+    """Два пула соединений: для коротких вызовов Bot API и для загрузки файлов."""
+    http_version = os.getenv("HTTP_VERSION", "1.1")
+    keepalive_expiry = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+    api = PooledRequest(
+        connection_pool_size=int(os.getenv("HTTP_POOL_SIZE", "256")),
+        keepalive_expiry=keepalive_expiry,
+        http_version=http_version,
+        connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+        read_timeout=float(os.getenv("HTTP_READ_TIMEOUT", "5")),
+        write_timeout=float(os.getenv("HTTP_WRITE_TIMEOUT", "5")),
+        pool_timeout=float(os.getenv("HTTP_POOL_TIMEOUT", "1"))
+    )
+    uploads = PooledRequest(
+        connection_pool_size=int(os.getenv("UPLOAD_POOL_SIZE", "16")),
+        keepalive_expiry=keepalive_expiry,
+        http_version=http_version,
+        connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+        read_timeout=float(os.getenv("UPLOAD_READ_TIMEOUT", "30")),
+        write_timeout=float(os.getenv("UPLOAD_WRITE_TIMEOUT", "60")),
+        media_write_timeout=float(os.getenv("UPLOAD_WRITE_TIMEOUT", "60")),
+        pool_timeout=float(os.getenv("UPLOAD_POOL_TIMEOUT", "10"))
     )
+    return ChannelRequest(api, uploads)
+
+def build_application(token: str, api_url: str = None, shard_index: int = 0, request=None):
+    """Собирает приложение со всеми обработчиками.
+
+    api_url позволяет направить бота на локальный Bot API, request — подменить HTTP-клиент целиком.
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .request(request or build_request())
+        .rate_limiter(RetryLimiter(
+            max_retries=int(os.getenv("BOT_MAX_RETRIES", "3")),
+            max_retry_after=float(os.getenv("BOT_MAX_RETRY_AFTER", "30")),
+            shared_bucket=lambda: outbox.global_bucket
+        ))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(PerUserUpdateProcessor(int(os.getenv("MAX_CONCURRENT_UPDATES", "256"))))
+    )
+    if api_url:
+        builder = builder.base_url(f"{api_url.rstrip('/')}/bot").base_file_url(f"{api_url.rstrip('/')}/file/bot")
+    application = builder.build()
+    application.bot_data['shard_index'] = shard_index
+
+    for problem in FLOW.check():
+        logger.warning("Conversation flow: %s", problem)
+    FLOW.add_observer(funnel.observe)
+    conv_handler = FLOW.build(wrap=timed)
+    # Состояние диалога хранится в сессии, и держать его в памяти дольше самой сессии незачем
+    sessions.add_evict_hook(conv_handler.forget)
 
     application.add_handler(conv_handler)
-    application.add_handler(CallbackQueryHandler(handle_callback_query, pattern='^show_photos_|show_pdf_|choose_platform$'))
+    application.add_handler(CommandHandler('broadcast', broadcast_command))
+    application.add_handler(CommandHandler('broadcast_status', broadcast_status_command))
+    application.add_handler(CommandHandler('export', export_command))
+    application.add_handler(CommandHandler('dead_letters', dead_letters_command))
+    application.add_handler(CommandHandler('funnel', funnel_command))
+    application.add_handler(CommandHandler('memory', memory_command))
+    application.add_handler(CommandHandler('qr', qr_command))
     application.add_error_handler(error_handler)
+    return application
+
+def run_webhook(application) -> None:
+    listen = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+    port = int(os.getenv("WEBHOOK_PORT", "8443"))
+    url_path = os.getenv("WEBHOOK_PATH", "telegram").strip('/')
+    secret_token = os.getenv("WEBHOOK_SECRET")
+    if not secret_token:
+        raise RuntimeError("WEBHOOK_SECRET must be set when BOT_MODE=webhook")
+
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if not webhook_url:
+        # Telegram принимает только HTTPS-адрес; http на адрес сервера понимает лишь локальный Bot API
+        if not os.getenv("BOT_API_URL"):
+            raise RuntimeError("WEBHOOK_URL must be set to a public HTTPS URL when BOT_MODE=webhook")
+        webhook_url = f"http://{listen}:{port}/{url_path}"
+    logger.info("Starting webhook server on %s:%s/%s", listen, port, url_path)
+    application.run_webhook(
+        listen=listen,
+        port=port,
+        url_path=url_path,
+        secret_token=secret_token,
+        webhook_url=webhook_url
+    )
+
+def setup_logging_from_env(shard_index: int = None) -> None:
+    log_file = os.getenv("LOG_FILE", "bot.log")
+    if log_file and shard_index is not None:
+        root, ext = os.path.splitext(log_file)
+        log_file = f"{root}.{shard_index}{ext}"
+    setup_logging(
+        level=os.getenv("LOG_LEVEL", "INFO"),
+        log_format=os.getenv("LOG_FORMAT", "json"),
+        log_file=log_file,
+        sample_rate=float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+    )
+
+def main() -> None:
+    load_dotenv()
+    setup_logging_from_env()
+
+    mode = os.getenv("BOT_MODE", "polling")
+    if mode == "sharded":
+        # Пользователь переезжает в другой процесс при смене BOT_WORKERS, и состояние диалога
+        # он должен найти в общем хранилище
+        if os.getenv("SESSION_BACKEND", "sqlite") != "sqlite":
+            raise RuntimeError("BOT_MODE=sharded requires SESSION_BACKEND=sqlite")
+        prepare_assets()
+        run_sharded(os.getenv("TOKEN_BOT"), int(os.getenv("BOT_WORKERS", str(os.cpu_count() or 1))), os.getenv("BOT_API_URL"))
+        return
+
+    configure_services()
+    application = build_application(os.getenv("TOKEN_BOT"), os.getenv("BOT_API_URL"))
 
-    application.run_polling()
+    if mode == "webhook":
+        run_webhook(application)
+    elif mode == "polling":
+        application.run_polling()
+    else:
+        raise RuntimeError(f"Unknown BOT_MODE: {mode}")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,216 @@
+"""Отчет о памяти процесса: размеры структур бота и места выделения памяти по tracemalloc.
+
+    python memory_report.py OLD NEW [--top 20]   # сравнить два сохраненных снимка
+
+Размеры структур отдают сами структуры через memory_usage() и считают их по выборке записей
+(см. sizing.py), а список сессий, который обойти нужно, разбирается порциями с возвратом
+управления циклу событий. Поэтому отчет можно запрашивать на работающем боте.
+
+tracemalloc замедляет выделение памяти, поэтому по умолчанию выключен и включается командой
+или MEMORY_TRACE_FRAMES. Каждый снимок сохраняется в каталог MEMORY_SNAPSHOT_DIR и сравнивается
+с первым снимком после включения и с предыдущим: утечка видна как строка, которая растет
+от снимка к снимку. Копирование трасс при снимке держит GIL, остальное — фильтрация,
+сравнение и запись на диск — идет в отдельном потоке.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+from asset_cache import asset_cache
+from flow import FlowConversationHandler
+from funnel import funnel
+from orders import order_index
+from outbox import outbox
+from qr_codes import qr_cache
+from render_state import render_cache
+from sizing import estimate
+from storage import sessions
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = 'memory_snapshots'
+# Сколько снимков одного процесса хранить на диске
+KEEP_SNAPSHOTS = 20
+FRAMES = 10
+TOP = 10
+CHUNK_SIZE = 5000
+MAX_REPLY = 4000
+
+# Внутренности tracemalloc и импорта только шумят в сравнении снимков
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def open_files() -> int:
+    """Число открытых дескрипторов процесса или -1, если /proc недоступен."""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return -1
+
+
+def resident_memory() -> int:
+    """RSS процесса в байтах или -1, если /proc недоступен."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return -1
+
+
+def format_bytes(size: int) -> str:
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def format_diff(stats: list, top: int = TOP) -> list:
+    lines = []
+    for stat in stats[:top]:
+        frame = stat.traceback[0]
+        lines.append(f"{format_bytes(stat.size_diff):>9} {stat.count_diff:+d} блоков  "
+                     f"{os.path.basename(frame.filename)}:{frame.lineno}")
+    return lines or ["изменений нет"]
+
+
+async def _instruction_ids() -> tuple:
+    """(сессий со списком, идентификаторов, байт) по сессиям в памяти."""
+    lists = ids = size = 0
+    for index, session in enumerate(sessions.cached(), 1):
+        message_ids = session.get('instruction_message_ids')
+        if message_ids:
+            lists += 1
+            ids += len(message_ids)
+            size += sys.getsizeof(message_ids) + sum(sys.getsizeof(item) for item in message_ids)
+        if index % CHUNK_SIZE == 0:
+            await asyncio.sleep(0)
+    return lists, ids, size
+
+
+class MemoryReport:
+    def __init__(self, directory: str = SNAPSHOT_DIR):
+        self.directory = directory
+        self._baseline = None
+        self._previous = None
+        self._saved = []
+        self._taken = 0
+        self._lock = asyncio.Lock()
+
+    def configure(self, directory: str, frames: int = 0):
+        self.directory = directory
+        if frames:
+            self.start_tracing(frames)
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start_tracing(self, frames: int = FRAMES):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            logger.info("tracemalloc started with %s frames", frames)
+
+    async def stop_tracing(self):
+        # Снимок, который сейчас снимается в потоке, сначала дописывается: без трасс он бы упал.
+        # После остановки трассы сброшены, старые снимки сравнивать уже не с чем
+        async with self._lock:
+            tracemalloc.stop()
+            self._baseline = self._previous = None
+        logger.info("tracemalloc stopped")
+
+    async def structures(self, application=None) -> list:
+        """(структура, записей, примерно байт) по структурам, которые растут вместе с числом пользователей."""
+        lists, ids, ids_size = await _instruction_ids()
+        rows = sessions.memory_usage()
+        rows.append((f'instruction_message_ids ({lists} сессий)', ids, ids_size))
+        for structure in (order_index, asset_cache, render_cache, qr_cache, funnel, outbox):
+            rows += structure.memory_usage()
+        if application is not None:
+            rows.append(('user_data', len(application.user_data), estimate(application.user_data)))
+            rows.append(('chat_data', len(application.chat_data), estimate(application.chat_data)))
+            for handlers in application.handlers.values():
+                for handler in handlers:
+                    if isinstance(handler, FlowConversationHandler):
+                        rows += handler.memory_usage()
+            limiter = application.bot.rate_limiter
+            if hasattr(limiter, 'memory_usage'):
+                rows += limiter.memory_usage()
+        return rows
+
+    async def report(self, application=None) -> str:
+        started = time.perf_counter()
+        rows = await self.structures(application)
+        traced = ""
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            traced = f", tracemalloc {format_bytes(current)} (пик {format_bytes(peak)})"
+        lines = [f"Память: RSS {format_bytes(resident_memory())}, открытых файлов {open_files()}{traced}",
+                 "структура: записей / примерно"]
+        lines += [f"{name}: {count} / {format_bytes(size)}" for name, count, size in rows]
+        lines.append(f"Отчет собран за {(time.perf_counter() - started) * 1000:.0f} мс")
+        return '\n'.join(lines)
+
+    def _take(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        os.makedirs(self.directory, exist_ok=True)
+        self._taken += 1
+        name = f"snapshot-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}-{self._taken}.tracemalloc"
+        path = os.path.join(self.directory, name)
+        snapshot.dump(path)
+        self._saved.append(path)
+        while len(self._saved) > KEEP_SNAPSHOTS:
+            try:
+                os.remove(self._saved.pop(0))
+            except OSError:
+                pass
+
+        lines = [f"Снимок {path}, {format_bytes(sum(stat.size for stat in snapshot.statistics('filename')))}"]
+        if self._baseline is None:
+            self._baseline = snapshot
+            lines.append("Это первый снимок, дальше сравнение пойдет с ним.")
+        else:
+            lines.append("Рост с первого снимка:")
+            lines += format_diff(snapshot.compare_to(self._baseline, 'lineno'))
+            if self._previous is not self._baseline:
+                lines.append("Рост с предыдущего снимка:")
+                lines += format_diff(snapshot.compare_to(self._previous, 'lineno'))
+        self._previous = snapshot
+        return '\n'.join(lines)
+
+    async def snapshot(self) -> str:
+        """Снимает tracemalloc, сохраняет его на диск и показывает, где память выросла."""
+        async with self._lock:
+            if not self.tracing:
+                return "tracemalloc выключен: /memory trace [кадры] или MEMORY_TRACE_FRAMES."
+            return await asyncio.to_thread(self._take)
+
+
+memory_report = MemoryReport()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two saved tracemalloc snapshots")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--key", default="lineno", choices=("lineno", "filename", "traceback"))
+    args = parser.parse_args()
+
+    old = tracemalloc.Snapshot.load(args.old)
+    new = tracemalloc.Snapshot.load(args.new)
+    for stat in new.compare_to(old, args.key)[:args.top]:
+        print(stat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+
+from logging_setup import log_state
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus. Наблюдение - один bisect и два сложения."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, labels: tuple, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            cumulative += counts[-1]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    'bot_handler_seconds', 'Time spent in update handlers.', ('handler', 'state', 'outcome')
+)
+api_request_seconds = registry.histogram(
+    'bot_api_request_seconds', 'Time spent in Bot API calls.', ('method', 'outcome')
+)
+
+
+def timed(state: str, callback):
+    """Оборачивает обработчик замером времени с меткой состояния разговора."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        log_state.set(state)
+        started = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return await callback(update, context)
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            handler_seconds.observe((name, state, outcome), time.perf_counter() - started)
+
+    return wrapper
+
+
+def api_outcome(error: Exception) -> str:
+    if isinstance(error, RetryAfter):
+        return 'retry_after'
+    if isinstance(error, TimedOut):
+        return 'timeout'
+    if isinstance(error, BadRequest):
+        return 'bad_request'
+    if isinstance(error, Forbidden):
+        return 'forbidden'
+    if isinstance(error, NetworkError):
+        return 'network_error'
+    return 'error'
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который считает и замеряет каждый вызов Bot API по методу и результату."""
+
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            outcome = api_outcome(e)
+            raise
+        finally:
+            api_request_seconds.observe((method, outcome), time.perf_counter() - started)
+
+
+class MetricsServer:
+    """Минимальный HTTP-сервер для /metrics на локальном адресе."""
+
+    def __init__(self):
+        self.routes = {'/metrics': ('text/plain; version=0.0.4', registry.render)}
+        self._server = None
+
+    def add_route(self, path: str, content_type: str, render):
+        self.routes[path] = (content_type, render)
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            route = self.routes.get(parts[1].split('?', 1)[0]) if len(parts) > 1 else None
+            if route:
+                content_type, render = route
+                body = render()
+                if asyncio.iscoroutine(body):
+                    body = await body
+                status = '200 OK'
+            else:
+                content_type, body, status = 'text/plain', 'Not Found\n', '404 Not Found'
+            data = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning("Metrics request failed: %s", e)
+        finally:
+            writer.close()
+
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info("Metrics endpoint listening on http://%s:%s/metrics", host, port)
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+metrics_server = MetricsServer()
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import logging
+import re
+
+from sizing import estimate
+
+logger = logging.getLogger(__name__)
+
+WATERMARK_KEY = 'orders:version'
+CATCH_UP_BATCH_SIZE = 1000
+
+# Шаблоны номеров заказов компилируются один раз при импорте
+ORDER_NUMBER_PATTERNS = {
+    'Ozon': re.compile(r'\d{8,10}-\d{4}(?:-\d{1,2})?'),
+    'Wildberries': re.compile(r'\d{7,15}'),
+    'Мегамаркет': re.compile(r'\d{8,14}'),
+    'ЯндексМаркет': re.compile(r'\d{8,12}'),
+}
+
+# Для неизвестной площадки проверяется только, что это похоже на номер
+DEFAULT_ORDER_NUMBER_PATTERN = re.compile(r'[\w-]{4,32}')
+
+ORDER_NUMBER_HINTS = {
+    'Ozon': "Номер заказа Ozon выглядит так: 12345678-0001. Проверьте номер и отправьте его еще раз.",
+    'Wildberries': "Номер заказа Wildberries состоит только из цифр. Проверьте номер и отправьте его еще раз.",
+    'Мегамаркет': "Номер заказа Мегамаркета состоит только из цифр. Проверьте номер и отправьте его еще раз.",
+    'ЯндексМаркет': "Номер заказа ЯндексМаркета состоит только из цифр. Проверьте номер и отправьте его еще раз.",
+}
+
+_DEFAULT_HINT = "Не получилось распознать номер заказа. Проверьте номер и отправьте его еще раз."
+
+DUPLICATE_ORDER_MESSAGE = (
+    "Этот номер заказа уже зарегистрирован. Если это ошибка, проверьте номер и отправьте его еще раз."
+)
+
+_SEPARATORS = re.compile(r'[\s№#]+')
+
+
+def normalize_order_number(text: str) -> str:
+    """Убирает пробелы и знаки № и #, которые пользователи добавляют к номеру."""
+    return _SEPARATORS.sub('', text or '').upper()
+
+
+def is_valid_order_number(platform: str, order_number: str) -> bool:
+    pattern = ORDER_NUMBER_PATTERNS.get(platform, DEFAULT_ORDER_NUMBER_PATTERN)
+    return pattern.fullmatch(order_number) is not None
+
+
+def order_number_hint(platform: str) -> str:
+    return ORDER_NUMBER_HINTS.get(platform, _DEFAULT_HINT)
+
+
+def _key(platform: str, order_number: str) -> tuple:
+    # Площадка может быть не выбрана, а в таблице orders она обязательна
+    return platform or '', order_number
+
+
+class OrderIndex:
+    """Хеш-индекс зарегистрированных номеров заказов: (площадка, номер) -> user_id.
+
+    Индекс хранится в таблице orders хранилища сессий. При запуске он загружается целиком,
+    а затем дополняется только сессиями, изменившимися после сохраненной версии,
+    поэтому проверка на дубль — одно обращение к словарю. Новые номера пишутся вместе
+    с очередной записью сессий.
+
+    Когда хранилище общее для нескольких процессов (shared), номер, которого нет в локальном
+    словаре, закрепляется сразу в хранилище: так дубль находится, даже если первый номер
+    принял другой процесс. Номер, который по локальному словарю занят другим, тоже
+    перепроверяется в хранилище: его мог освободить владелец в другом процессе.
+
+    За пользователем закреплен один номер — тот, что в его анкете. Когда он вводит новый,
+    прежний освобождается.
+    """
+
+    def __init__(self, shared: bool = False):
+        self.shared = shared
+        self._owners = {}
+        # user_id -> (площадка, номер), закрепленный за пользователем
+        self._claimed = {}
+        # user_id -> ((площадка, номер), освободить ли прежние номера) — последний номер пользователя до записи
+        self._changed = {}
+        self._store = None
+
+    def __len__(self):
+        return len(self._owners)
+
+    def memory_usage(self) -> list:
+        return [('order_index', len(self._owners), estimate(self._owners) + estimate(self._claimed))]
+
+    async def load(self, store):
+        self._store = store
+        backend = store.backend
+        rows = await asyncio.to_thread(backend.load_orders)
+        self._owners = {(platform, order_number): user_id for platform, order_number, user_id in rows}
+        self._claimed = {user_id: key for key, user_id in self._owners.items()}
+
+        await store.flush()
+        since = await store.get_meta(WATERMARK_KEY) or 0
+        found, watermark = await asyncio.to_thread(self._catch_up, backend, since)
+        if watermark != since:
+            await store.put_meta(WATERMARK_KEY, watermark)
+        await self.flush()
+        logger.info("Order index: %s orders loaded, %s found in changed sessions", len(rows), found)
+
+    def _catch_up(self, backend, version: int) -> tuple:
+        found = 0
+        while True:
+            rows = backend.changed_since(version, CATCH_UP_BATCH_SIZE)
+            if not rows:
+                return found, version
+            for user_id, data, _, version in rows:
+                user_info = json.loads(data)
+                order_number = user_info.get('order_number')
+                key = _key(user_info.get('platform'), order_number)
+                if order_number and key not in self._owners:
+                    self.add(*key, user_id)
+                    found += 1
+
+    async def claim(self, platform: str, order_number: str, user_id: int) -> bool:
+        """Закрепляет номер за пользователем. Возвращает False, если номер уже занят другим."""
+        key = _key(platform, order_number)
+        previous = self._claimed.get(user_id)
+        owner = self._owners.get(key)
+        if owner != user_id and self.shared and self._store is not None:
+            owner = await asyncio.to_thread(self._store.backend.claim_order, *key, user_id)
+            self._owners[key] = owner
+        elif owner is None:
+            self.add(platform, order_number, user_id)
+            owner = user_id
+        if owner != user_id:
+            return False
+        self._claimed[user_id] = key
+        if previous is not None and previous != key:
+            if self._owners.get(previous) == user_id:
+                del self._owners[previous]
+            self._change(user_id, key, release=True)
+        return True
+
+    def add(self, platform: str, order_number: str, user_id: int):
+        key = _key(platform, order_number)
+        if key not in self._owners:
+            self._owners[key] = user_id
+            self._claimed[user_id] = key
+            self._change(user_id, key)
+
+    def _change(self, user_id: int, key: tuple, release: bool = False):
+        # Из нескольких номеров пользователя до записи важен только последний: промежуточные
+        # освобождения иначе удалили бы номер, закрепленный позже
+        _, released = self._changed.get(user_id, (None, False))
+        self._changed[user_id] = (key, release or released)
+
+    async def flush(self):
+        if self._store is None or not self._changed:
+            return
+        changed, self._changed = self._changed, {}
+        rows = [key + (user_id, release) for user_id, (key, release) in changed.items()]
+        try:
+            await asyncio.to_thread(self._store.backend.write_orders, rows)
+        except Exception:
+            # Изменения, сделанные во время записи, новее неудавшихся
+            for user_id, (key, release) in changed.items():
+                newer = self._changed.get(user_id)
+                self._changed[user_id] = (newer[0], newer[1] or release) if newer else (key, release)
+            raise
+
+
+order_index = OrderIndex()
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram.error import BadRequest, RetryAfter
+
+from asset_cache import asset_cache, sent_file_id
+from dead_letters import dead_letters
+from retry import METERED, is_transient
+from sizing import estimate
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничивает частоту операций: rate токенов в секунду, не более capacity подряд."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    async def acquire(self, reserve: float = 0):
+        """Забирает токен. С reserve токен берется, только если после этого в ведре останется не меньше reserve."""
+        needed = 1 + reserve
+        while True:
+            self._refill()
+            if self._tokens >= needed:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((needed - self._tokens) / self.rate)
+
+
+class OutboundMessage:
+    __slots__ = ('method', 'kwargs', 'paced', 'asset', 'error_text', 'future')
+
+    def __init__(self, method, kwargs, paced, asset, error_text, future):
+        self.method = method
+        self.kwargs = kwargs
+        self.paced = paced
+        self.asset = asset
+        self.error_text = error_text
+        self.future = future
+
+
+def _consume_exception(future):
+    # Результат отправки часто никто не ждет; помечаем исключение как полученное
+    if not future.cancelled():
+        future.exception()
+
+
+class Outbox:
+    """Очередь исходящих сообщений: порядок внутри чата сохраняется, частота ограничена
+    глобальным и чатовым token bucket, а обработчик не ждет окончания отправки.
+
+    Повторы после сбоев выполняет RetryLimiter бота. Сообщения, которые не удалось доставить
+    и после повторов, не поместились в очередь чата (max_pending) или остались в очереди
+    при остановке, записываются в журнал dead_letters.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3, pace: float = 2.0,
+                 max_pending: int = 100):
+        self.pace = pace
+        self.max_pending = max_pending
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets = {}
+        self._swept = time.monotonic()
+        self._queues = {}
+        self._workers = {}
+        self._bot = None
+
+    def configure(self, global_rate: float = None, chat_rate: float = None, chat_burst: float = None, pace: float = None,
+                  max_pending: int = None):
+        if global_rate is not None:
+            self._global = TokenBucket(global_rate, global_rate)
+        if chat_rate is not None:
+            self._chat_rate = chat_rate
+        if chat_burst is not None:
+            self._chat_burst = chat_burst
+        if pace is not None:
+            self.pace = pace
+        if max_pending is not None:
+            self.max_pending = max_pending
+
+    def start(self, bot):
+        self._bot = bot
+
+    @property
+    def bot(self):
+        return self._bot
+
+    @property
+    def global_bucket(self) -> TokenBucket:
+        return self._global
+
+    def submit(self, chat_id, method: str, paced: bool = False, asset=None, error_text: str = None, **kwargs) -> asyncio.Future:
+        """Ставит вызов метода бота в очередь чата.
+
+        paced - выдержать паузу self.pace после сообщения перед следующим в этом чате;
+        asset - пара (имя аргумента, путь к файлу), файл подставляется через asset_cache;
+        error_text - текст, который отправляется пользователю, если вызов не удался.
+        """
+        if self._bot is None:
+            raise RuntimeError("Outbox is not started")
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        queue = self._queues.setdefault(chat_id, deque())
+        if len(queue) >= self.max_pending:
+            error = RuntimeError(f"Outbox queue for chat {chat_id} is full")
+            dead_letters.record(chat_id, method, kwargs, asset, error)
+            future.set_exception(error)
+            return future
+        queue.append(OutboundMessage(method, kwargs, paced, asset, error_text, future))
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return future
+
+    async def join(self):
+        """Ждет, пока очереди всех чатов опустеют."""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    def pending(self, chat_id) -> int:
+        return len(self._queues.get(chat_id, ()))
+
+    def memory_usage(self) -> list:
+        return [
+            ('outbox queues', sum(len(queue) for queue in self._queues.values()),
+             estimate(self._queues) + estimate(self._workers)),
+            ('outbox chat buckets', len(self._chat_buckets), estimate(self._chat_buckets)),
+        ]
+
+    async def _drain(self, chat_id):
+        queue = self._queues[chat_id]
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        try:
+            while queue:
+                # Пока ждем токены, сообщение остается в очереди: если воркер отменят, его запишет в журнал close()
+                await bucket.acquire()
+                await self._global.acquire()
+                job = queue.popleft()
+                await self._deliver(chat_id, job)
+                if job.paced:
+                    await asyncio.sleep(self.pace)
+        finally:
+            del self._workers[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+            if bucket.full:
+                self._chat_buckets.pop(chat_id, None)
+            self._sweep()
+
+    def _sweep(self):
+        """Убирает ведра чатов без очереди, которые уже наполнились.
+
+        Ведро, опустевшее на последнем сообщении чата, наполняется за chat_burst / chat_rate секунд
+        и после этого ничем не отличается от нового. Проверка идет не чаще раза за это время.
+        """
+        now = time.monotonic()
+        if now - self._swept < self._chat_burst / self._chat_rate:
+            return
+        self._swept = now
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items()
+                        if chat_id not in self._workers and bucket.full]:
+            del self._chat_buckets[chat_id]
+
+    async def _call(self, chat_id, job):
+        method = getattr(self._bot, job.method)
+        # Токен общего ведра _drain уже взял
+        if not job.asset:
+            return await method(chat_id=chat_id, rate_limit_args=METERED, **job.kwargs)
+        name, path = job.asset
+        while True:
+            with asset_cache.input_file(path) as file:
+                try:
+                    result = await method(chat_id=chat_id, **{name: file}, rate_limit_args=METERED, **job.kwargs)
+                except BadRequest:
+                    # Сетевой сбой или 429 ничего не говорят о file_id, а BadRequest может значить, что он устарел:
+                    # file_id забывается, и файл один раз загружается заново
+                    if not isinstance(file, str):
+                        raise
+                    asset_cache.forget(path)
+                    continue
+            break
+        asset_cache.remember(path, sent_file_id(result))
+        return result
+
+    async def _deliver(self, chat_id, job):
+        try:
+            result = await self._call(chat_id, job)
+        except asyncio.CancelledError:
+            dead_letters.record(chat_id, job.method, job.kwargs, job.asset, RuntimeError("Outbox closed"))
+            job.future.cancel()
+            raise
+        except Exception as e:
+            logger.error("Error calling %s for chat %s: %s", job.method, chat_id, e)
+            # BadRequest и Forbidden при повторе не пройдут, в журнал идут только сбои доставки
+            if isinstance(e, RetryAfter) or is_transient(e):
+                dead_letters.record(chat_id, job.method, job.kwargs, job.asset, e)
+            job.future.set_exception(e)
+            if job.error_text:
+                try:
+                    await self._bot.send_message(chat_id=chat_id, text=job.error_text)
+                except Exception as e:
+                    logger.error("Error sending error message to chat %s: %s", chat_id, e)
+            return
+        job.future.set_result(result)
+
+    async def close(self, timeout: float = 10.0):
+        workers = list(self._workers.values())
+        if workers:
+            done, pending = await asyncio.wait(workers, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        # Сообщения, до которых очередь не дошла, не теряются, а попадают в журнал
+        for chat_id, queue in self._queues.items():
+            for job in queue:
+                dead_letters.record(chat_id, job.method, job.kwargs, job.asset, RuntimeError("Outbox closed"))
+                job.future.cancel()
+        self._queues.clear()
+
+
+outbox = Outbox()
@@ -1,33 +1,201 @@
+import argparse
+import asyncio
+import csv
+import hashlib
+import io
+import logging
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 import qrcode
 
-def generate_qr_code(category: str, bot_username: str) -> str:
-    base_url = f"https://t.me/{bot_username}?start={category}"
+from config import category_cases
+
+logger = logging.getLogger(__name__)
+
+QR_OUTPUT_DIR = 'photo/qr'
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+# Сколько PNG держать в памяти для отправки в чат; один код весит около 1 КБ
+QR_CACHE_SIZE = 1024
+
+# Параметр start в deep-link: до 64 символов A-Z, a-z, 0-9, _ и -
+DEEP_LINK_PAYLOAD = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+categories = {
+    'bed_linen': 'Постельное белье',
+    'towel': 'Полотенца',
+    'blanket': 'Пледы'
+}
+
+# Код из deep-link -> категория; дополняется кампаниями из load_campaigns()
+campaigns = dict(categories)
+
+
+def deep_link(code: str, bot_username: str) -> str:
+    return f"https://t.me/{bot_username}?start={code}"
+
+
+def render_qr_png(data: str) -> bytes:
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
+        box_size=QR_BOX_SIZE,
+        border=QR_BORDER,
     )
-    qr.add_data(base_url)
+    qr.add_data(data)
     qr.make(fit=True)
 
     img = qr.make_image(fill='black', back_color='white')
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def qr_path(code: str, bot_username: str, out_dir: str = QR_OUTPUT_DIR) -> str:
+    """Путь к PNG зависит от содержимого кода, поэтому неизменившиеся коды не перерисовываются."""
+    key = f"{deep_link(code, bot_username)}|{QR_BOX_SIZE}|{QR_BORDER}"
+    digest = hashlib.sha256(key.encode()).hexdigest()[:12]
+    return os.path.join(out_dir, f"{code}_{digest}.png")
+
+
+def _render_to_file(job) -> str:
+    data, path = job
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as file:
+        file.write(render_qr_png(data))
+    os.replace(tmp_path, path)
+    return path
+
+
+def generate_batch(codes, bot_username: str, out_dir: str = QR_OUTPUT_DIR, workers: int = None) -> dict:
+    """Рисует QR-коды для множества кодов параллельно в пуле процессов. Возвращает код -> путь к PNG."""
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    jobs = []
+    for code in codes:
+        if not DEEP_LINK_PAYLOAD.match(code):
+            raise ValueError(f"Invalid deep-link payload: {code!r}")
+        path = qr_path(code, bot_username, out_dir)
+        paths[code] = path
+        if not os.path.exists(path):
+            jobs.append((deep_link(code, bot_username), path))
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(_render_to_file, jobs, chunksize=max(1, len(jobs) // 64)):
+                pass
+    logger.info("QR batch: %s codes, %s rendered, %s up to date", len(paths), len(jobs), len(paths) - len(jobs))
+    return paths
+
+
+class QRCache:
+    """PNG-байты QR-кодов для отправки прямо в чат, max_entries последних использованных.
+
+    При промахе PNG берется из уже отрисованного generate_batch файла, а если его нет — рисуется.
+    """
+
+    def __init__(self, max_entries: int = QR_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def memory_usage(self) -> list:
+        return [('qr_cache', len(self._entries), sum(len(png) for png in self._entries.values()))]
+
+    def _hit(self, key):
+        png = self._entries.get(key)
+        if png is not None:
+            self._entries.move_to_end(key)
+        return png
+
+    def _put(self, key, png: bytes) -> bytes:
+        self._entries[key] = png
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return png
+
+    @staticmethod
+    def _load(code: str, bot_username: str, out_dir: str) -> bytes:
+        try:
+            with open(qr_path(code, bot_username, out_dir), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return render_qr_png(deep_link(code, bot_username))
+
+    def get(self, code: str, bot_username: str, out_dir: str = QR_OUTPUT_DIR) -> bytes:
+        key = (code, bot_username)
+        png = self._hit(key)
+        return png if png is not None else self._put(key, self._load(code, bot_username, out_dir))
+
+    async def fetch(self, code: str, bot_username: str, out_dir: str = QR_OUTPUT_DIR) -> bytes:
+        """get() для цикла событий: чтение файла и отрисовка при промахе идут в отдельном потоке."""
+        key = (code, bot_username)
+        png = self._hit(key)
+        if png is None:
+            png = self._put(key, await asyncio.to_thread(self._load, code, bot_username, out_dir))
+        return png
+
+
+qr_cache = QRCache()
+
+
+def generate_qr_code(category: str, bot_username: str) -> str:
     img_path = f"{category}_qr.png"
-    img.save(img_path)
+    with open(img_path, 'wb') as file:
+        file.write(qr_cache.get(category, bot_username))
     return img_path
 
+
+def load_campaigns(path: str) -> int:
+    """Загружает кампании из CSV с колонками code,category.
+
+    Строки с неизвестной категорией пропускаются: для нее нет текстов, и пользователь получил бы
+    пустое приветствие.
+    """
+    loaded = 0
+    with open(path, encoding='utf-8', newline='') as file:
+        for row in csv.DictReader(file):
+            code = row['code'].strip()
+            if not DEEP_LINK_PAYLOAD.match(code):
+                logger.warning("Skipping invalid campaign code %r", code)
+                continue
+            category = row['category'].strip()
+            if category not in category_cases:
+                logger.warning("Skipping campaign code %r with unknown category %r", code, category)
+                continue
+            campaigns[code] = category
+            loaded += 1
+    logger.info("Loaded %s campaign codes from %s", loaded, path)
+    return loaded
+
+
 def get_product_category(qr_code: str) -> str:
-    categories = {
-        'bed_linen': 'Постельное белье',
-        'towel': 'Полотенца',
-        'blanket': 'Пледы'
-    }
-    return categories.get(qr_code, 'Unknown category')
+    return campaigns.get(qr_code, 'Unknown category')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate deep-link QR codes")
+    parser.add_argument('codes', nargs='*', help="deep-link codes; defaults to every known campaign")
+    parser.add_argument('--bot', default="MirrorSleep_customer_bot", help="bot username")
+    parser.add_argument('--campaigns', help="CSV file with code,category columns")
+    parser.add_argument('--out', default=QR_OUTPUT_DIR)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if args.campaigns:
+        load_campaigns(args.campaigns)
+    paths = generate_batch(args.codes or list(campaigns), args.bot, args.out, args.workers)
+    for code, path in paths.items():
+        print(f"{code}: {path}")
+
 
 if __name__ == "__main__":
-    bot_username = "MirrorSleep_customer_bot"  
-    category = "blanket"  
-    img_path = generate_qr_code(category, bot_username)
-    print(f"QR-код сохранен по адресу: {img_path}")
+    main()
 
-# https://t.me/MirrorSleep_customer_bot?start=Постельное белье
\ No newline at end of file
+# https://t.me/MirrorSleep_customer_bot?start=Постельное белье
@@ -0,0 +1,40 @@
+from config import messages, category_cases
+
+# Шаблоны разбираются один раз при импорте: категория подставляется заранее,
+# а на каждый апдейт остается только склеить части с именем пользователя
+
+_NAME_SLOT = '\0'
+
+intro_templates = {
+    'Постельное белье': 'intro_bed_linen',
+    'Полотенца': 'intro_towel',
+    'Пледы': 'intro_blanket'
+}
+
+
+def _compile_intro(template: str, category: str) -> tuple:
+    return tuple(template.format(name=_NAME_SLOT, category=category).split(_NAME_SLOT))
+
+
+INTRO_PARTS = {
+    category: _compile_intro(messages[key], category)
+    for category, key in intro_templates.items()
+}
+
+SUBSCRIBE_MESSAGES = {
+    category: messages["subscribe"].format(category=case)
+    for category, case in category_cases.items()
+}
+
+_SUBSCRIBE_DEFAULT = messages["subscribe"].format(category=category_cases.get(None))
+
+
+def render_intro(user_info: dict) -> str:
+    parts = INTRO_PARTS.get(user_info['category'])
+    if parts is None:
+        return ""
+    return user_info['name'].join(parts)
+
+
+def render_subscribe(category: str) -> str:
+    return SUBSCRIBE_MESSAGES.get(category, _SUBSCRIBE_DEFAULT)
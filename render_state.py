@@ -0,0 +1,86 @@
+"""Кеш последнего отрисованного содержимого сообщений бота.
+
+Повторное нажатие "Главное меню" или "Личный кабинет" просит отредактировать сообщение
+в то же состояние. Telegram отвечает на это ошибкой "message is not modified", поэтому
+edit_message сравнивает новое содержимое с последним отрисованным и не делает запрос,
+если ничего не изменилось, а если изменилась только клавиатура — меняет только ее.
+"""
+import logging
+from collections import OrderedDict
+
+from telegram.error import BadRequest
+
+from sizing import estimate
+
+logger = logging.getLogger(__name__)
+
+MAX_ENTRIES = 50000
+
+
+def is_not_modified(error: Exception) -> bool:
+    return isinstance(error, BadRequest) and 'message is not modified' in str(error).lower()
+
+
+class RenderCache:
+    """(chat_id, message_id) -> (хеш текста, хеш клавиатуры) для max_entries последних сообщений."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def memory_usage(self) -> list:
+        return [('render_cache', len(self._entries), estimate(self._entries))]
+
+    def get(self, chat_id, message_id):
+        key = (chat_id, message_id)
+        state = self._entries.get(key)
+        if state is not None:
+            self._entries.move_to_end(key)
+        return state
+
+    def put(self, chat_id, message_id, text: str, reply_markup=None):
+        key = (chat_id, message_id)
+        self._entries[key] = (hash(text), hash(reply_markup))
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def forget(self, chat_id, message_id):
+        self._entries.pop((chat_id, message_id), None)
+
+
+render_cache = RenderCache()
+
+
+async def edit_message(message, text: str, reply_markup=None, **kwargs):
+    """Редактирует сообщение бота, пропуская запрос, если содержимое не изменилось.
+
+    Если сообщения нет в кеше (например, после перезапуска), сравнение идет с текстом
+    и клавиатурой, которые пришли вместе с нажатием кнопки.
+    """
+    chat_id, message_id = message.chat_id, message.message_id
+    state = render_cache.get(chat_id, message_id)
+    if state is None:
+        state = (hash(message.text), hash(message.reply_markup))
+    text_hash, markup_hash = hash(text), hash(reply_markup)
+
+    if state == (text_hash, markup_hash):
+        render_cache.skipped += 1
+        render_cache.put(chat_id, message_id, text, reply_markup)
+        return None
+    try:
+        if state[0] == text_hash:
+            result = await message.edit_reply_markup(reply_markup=reply_markup, **kwargs)
+        else:
+            result = await message.edit_text(text=text, reply_markup=reply_markup, **kwargs)
+    except BadRequest as e:
+        if not is_not_modified(e):
+            render_cache.forget(chat_id, message_id)
+            raise
+        result = None
+    render_cache.put(chat_id, message_id, text, reply_markup)
+    return result
@@ -0,0 +1,143 @@
+"""Повтор вызовов Bot API после сетевых сбоев и ответов 429.
+
+RetryLimiter подключается к приложению как rate limiter PTB и видит каждый вызов бота,
+поэтому повторы работают и для прямых вызовов из обработчиков, и для outbox.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.ext import BaseRateLimiter
+
+from sizing import estimate
+
+logger = logging.getLogger(__name__)
+
+# Таймаут чтения не значит, что сообщение не дошло: повтор send_* может прислать его дважды,
+# поэтому после TimedOut повторяются только методы, которые безопасно выполнить еще раз
+IDEMPOTENT_METHODS = frozenset({
+    'answerCallbackQuery', 'deleteMessage', 'deleteMessages', 'editMessageText', 'editMessageReplyMarkup',
+    'editMessageCaption', 'getMe', 'getChat', 'getFile', 'deleteWebhook', 'setWebhook'
+})
+
+# getUpdates повторяет сам Updater
+SKIPPED_METHODS = frozenset({'getUpdates'})
+
+# Отправка сообщений, которая расходует общий лимит бота на сообщения в секунду
+SENDING_METHODS = frozenset({
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendMediaGroup', 'sendVideo', 'sendAnimation', 'sendAudio',
+    'sendVoice', 'sendSticker', 'sendContact', 'sendLocation', 'copyMessage', 'forwardMessage'
+})
+
+# rate_limit_args вызова, для которого токен общего ведра уже взят
+METERED = {'metered': True}
+
+
+def is_transient(error: Exception) -> bool:
+    """Сетевые сбои и таймауты стоит повторить, а BadRequest повторится с той же ошибкой."""
+    return isinstance(error, NetworkError) and not isinstance(error, BadRequest)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+class RetryLimiter(BaseRateLimiter):
+    """Повторяет вызовы Bot API не больше max_retries раз.
+
+    RetryAfter задерживает все вызовы в тот же чат на запрошенное время, остальные чаты
+    не ждут. Если за storm_window секунд пришло storm_threshold ответов 429, на это время
+    приостанавливаются вызовы во все чаты: дальше бить в лимит бесполезно, а каждая лишняя
+    попытка его продлевает. Ожидание дольше max_retry_after не выполняется, ошибка уходит
+    вызывающему. Вызов с rate_limit_args={'max_retries': 0} выполняется без повторов.
+
+    shared_bucket — функция, которая возвращает общее ведро отправки (outbox.global_bucket).
+    Тогда отправка сообщения напрямую из обработчика тоже берет из него токен, и рассылка,
+    оставляющая в ведре резерв, видит весь поток сообщений, а не только outbox. Вызовы
+    с rate_limit_args={'metered': True} токен уже взяли сами.
+    """
+
+    def __init__(self, max_retries: int = 3, max_retry_after: float = 30.0, max_backoff: float = 10.0,
+                 storm_threshold: int = 5, storm_window: float = 10.0, shared_bucket=None):
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.max_backoff = max_backoff
+        self.storm_threshold = storm_threshold
+        self.storm_window = storm_window
+        self.shared_bucket = shared_bucket
+        self._chat_until = {}
+        self._floods = deque()
+        self._paused_until = 0.0
+
+    def memory_usage(self) -> list:
+        return [('retry chat delays', len(self._chat_until), estimate(self._chat_until))]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def _wait(self, chat_id):
+        while True:
+            now = time.monotonic()
+            until = self._paused_until
+            if chat_id is not None:
+                chat_until = self._chat_until.get(chat_id, 0.0)
+                if chat_until <= now:
+                    self._chat_until.pop(chat_id, None)
+                until = max(until, chat_until)
+            if until <= now:
+                return
+            await asyncio.sleep(until - now)
+
+    def _on_flood(self, chat_id, retry_after: float):
+        now = time.monotonic()
+        if chat_id is not None:
+            self._chat_until[chat_id] = max(self._chat_until.get(chat_id, 0.0), now + retry_after)
+        self._floods.append(now)
+        while self._floods and self._floods[0] < now - self.storm_window:
+            self._floods.popleft()
+        if len(self._floods) >= self.storm_threshold and now + retry_after > self._paused_until:
+            logger.warning("Flood control storm: %s x 429 in %s s, pausing all chats for %s s",
+                           len(self._floods), self.storm_window, retry_after)
+            self._paused_until = now + retry_after
+
+    def _delay(self, endpoint: str, error: Exception, attempt: int):
+        """Пауза перед следующей попыткой или None, если повторять не нужно."""
+        if isinstance(error, RetryAfter):
+            retry_after = retry_after_seconds(error)
+            return retry_after if retry_after <= self.max_retry_after else None
+        if isinstance(error, TimedOut) and endpoint not in IDEMPOTENT_METHODS:
+            return None
+        if is_transient(error):
+            return min(self.max_backoff, 2 ** attempt) * random.uniform(0.5, 1.0)
+        return None
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in SKIPPED_METHODS:
+            return await callback(*args, **kwargs)
+
+        rate_limit_args = rate_limit_args or {}
+        max_retries = rate_limit_args.get('max_retries', self.max_retries)
+        chat_id = data.get('chat_id')
+        if self.shared_bucket is not None and endpoint in SENDING_METHODS and not rate_limit_args.get('metered'):
+            await self.shared_bucket().acquire()
+        attempt = 0
+        while True:
+            await self._wait(chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except Exception as e:
+                if isinstance(e, RetryAfter):
+                    self._on_flood(chat_id, retry_after_seconds(e))
+                delay = self._delay(endpoint, e, attempt) if attempt < max_retries else None
+                if delay is None:
+                    raise
+                attempt += 1
+                logger.warning("Retrying %s for chat %s in %.1f s after %s", endpoint, chat_id, delay, e)
+                await asyncio.sleep(delay)
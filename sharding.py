@@ -0,0 +1,185 @@
+"""Запуск бота в нескольких процессах.
+
+    BOT_MODE=sharded BOT_WORKERS=4 python main.py
+
+Процесс-диспетчер один получает апдейты через getUpdates и раздает их рабочим процессам по
+user_id % N, поэтому апдейты одного пользователя всегда обрабатывает один процесс и по
+порядку. Рабочий процесс — обычное приложение со всеми обработчиками, только без polling.
+Сессии вместе с состоянием диалога, индекс заказов и служебные данные лежат в общем SQLite
+(SESSION_BACKEND=sqlite), так что число процессов можно менять между перезапусками: после смены N
+пользователь попадает в другой процесс, и тот продолжает диалог с сохраненного состояния
+(см. ResumeHandler во flow.py). Рабочие процессы записывают сессии при остановке, поэтому
+перезапускать с новым N нужно после того, как остановились все старые.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import time
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_URL = 'https://api.telegram.org'
+POLL_TIMEOUT = 30
+POLL_LIMIT = 100
+QUEUE_SIZE = 10000
+MAX_BACKOFF = 30.0
+
+
+def raw_update_key(data: dict):
+    """То же, что update_processor.update_key, но по JSON апдейта без разбора в объекты."""
+    for kind, payload in data.items():
+        if kind == 'update_id' or not isinstance(payload, dict):
+            continue
+        user = payload.get('from') or payload.get('user')
+        if user:
+            return user['id']
+        chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+    return None
+
+
+def shard_for(data: dict, shard_count: int) -> int:
+    key = raw_update_key(data)
+    return key % shard_count if key is not None else 0
+
+
+def run_worker(shard_index: int, shard_count: int, token: str, api_url: str, inbox):
+    """Точка входа рабочего процесса: обрабатывает апдейты из inbox до получения None."""
+    # Останавливает рабочие процессы диспетчер, поэтому Ctrl+C в терминале они игнорируют
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from dotenv import load_dotenv
+    from main import build_application, configure_services, setup_logging_from_env
+
+    load_dotenv()
+    setup_logging_from_env(shard_index)
+    configure_services(shard_count, shard_index)
+    application = build_application(token, api_url, shard_index)
+    asyncio.run(_serve(application, inbox))
+
+
+async def _serve(application, inbox):
+    from telegram import Update
+    from main import on_startup, on_stop, on_shutdown
+
+    async with application:
+        await on_startup(application)
+        await application.start()
+        logger.info("Worker %s started", application.bot_data['shard_index'])
+        try:
+            while True:
+                data = await asyncio.to_thread(inbox.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+        finally:
+            await application.stop()
+            await on_stop(application)
+            await on_shutdown(application)
+
+
+class Dispatcher:
+    """Получает апдейты через getUpdates и раскладывает их по очередям рабочих процессов."""
+
+    def __init__(self, token: str, shard_count: int, api_url: str = None, poll_timeout: int = POLL_TIMEOUT):
+        self.token = token
+        self.shard_count = shard_count
+        self.worker_api_url = api_url
+        self.api_url = (api_url or DEFAULT_API_URL).rstrip('/')
+        self.poll_timeout = poll_timeout
+        self.queues = []
+        self.workers = []
+        self.dispatched = 0
+        self.offset = None
+        self._running = False
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        for shard_index in range(self.shard_count):
+            inbox = context.Queue(QUEUE_SIZE)
+            worker = context.Process(
+                target=run_worker, name=f"bot-worker-{shard_index}",
+                args=(shard_index, self.shard_count, self.token, self.worker_api_url, inbox)
+            )
+            worker.start()
+            self.queues.append(inbox)
+            self.workers.append(worker)
+        self._running = True
+        logger.info("Started %s workers", self.shard_count)
+
+    def dispatch(self, data: dict):
+        self.queues[shard_for(data, self.shard_count)].put(json.dumps(data, ensure_ascii=False))
+        self.dispatched += 1
+
+    def _call(self, client: httpx.Client, method: str, **params):
+        params = {key: value for key, value in params.items() if value is not None}
+        response = client.post(f"{self.api_url}/bot{self.token}/{method}", json=params)
+        payload = response.json()
+        if not payload.get('ok'):
+            retry_after = (payload.get('parameters') or {}).get('retry_after')
+            raise RuntimeError(payload.get('description', 'Bot API error'), retry_after)
+        return payload['result']
+
+    def poll(self):
+        """Цикл getUpdates. Смещение подтверждается следующим запросом, уже после раздачи апдейтов."""
+        backoff = 1.0
+        webhook_deleted = False
+        with httpx.Client(timeout=self.poll_timeout + 10) as client:
+            while self._running:
+                method = 'getUpdates' if webhook_deleted else 'deleteWebhook'
+                try:
+                    if not webhook_deleted:
+                        self._call(client, 'deleteWebhook')
+                        webhook_deleted = True
+                    updates = self._call(client, 'getUpdates', offset=self.offset, limit=POLL_LIMIT, timeout=self.poll_timeout)
+                except (httpx.HTTPError, ValueError, RuntimeError) as e:
+                    retry_after = e.args[1] if isinstance(e, RuntimeError) and len(e.args) > 1 else None
+                    delay = retry_after or backoff
+                    logger.warning("%s failed: %s, retrying in %s s", method, e, delay)
+                    time.sleep(delay)
+                    backoff = min(MAX_BACKOFF, backoff * 2)
+                    continue
+                backoff = 1.0
+                for data in updates:
+                    self.dispatch(data)
+                    self.offset = data['update_id'] + 1
+
+    def _confirm(self):
+        """Подтверждает уже разданные апдейты, чтобы после перезапуска они не пришли снова."""
+        if self.offset is None:
+            return
+        try:
+            with httpx.Client(timeout=10) as client:
+                self._call(client, 'getUpdates', offset=self.offset, limit=1, timeout=0)
+        except (httpx.HTTPError, ValueError, RuntimeError) as e:
+            logger.warning("Could not confirm update offset %s: %s", self.offset, e)
+
+    def stop(self, timeout: float = 30.0):
+        self._running = False
+        self._confirm()
+        for inbox in self.queues:
+            inbox.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+            if worker.is_alive():
+                logger.warning("Worker %s did not stop in time, terminating", worker.name)
+                worker.terminate()
+        logger.info("Dispatched %s updates", self.dispatched)
+
+
+def run_sharded(token: str, shard_count: int, api_url: str = None):
+    dispatcher = Dispatcher(token, shard_count, api_url)
+    signal.signal(signal.SIGTERM, lambda signum, frame: signal.raise_signal(signal.SIGINT))
+    dispatcher.start()
+    try:
+        dispatcher.poll()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.stop()
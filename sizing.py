@@ -0,0 +1,36 @@
+"""Примерный объем структур в памяти для отчета /memory.
+
+Каждая структура, которая растет вместе с числом пользователей, отдает memory_usage() —
+список строк (название, записей, примерно байт). Словари из сотен тысяч записей не обходятся
+целиком: средний размер записи считается по первым SAMPLE_SIZE записям.
+"""
+import itertools
+import sys
+
+SAMPLE_SIZE = 100
+
+
+def deep_size(value, depth: int = 3) -> int:
+    """Размер значения вместе с вложенными контейнерами до глубины depth."""
+    approx_size = getattr(value, 'approx_size', None)
+    if approx_size is not None:
+        return approx_size()
+    size = sys.getsizeof(value)
+    if depth <= 0:
+        return size
+    if isinstance(value, dict):
+        size += sum(deep_size(key, depth - 1) + deep_size(item, depth - 1) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, depth - 1) for item in value)
+    return size
+
+
+def estimate(mapping) -> int:
+    """Примерный размер словаря: сам словарь плюс средний размер первых записей, умноженный на их число."""
+    size = sys.getsizeof(mapping)
+    count = len(mapping)
+    if not count:
+        return size
+    sample = list(itertools.islice(mapping.items(), SAMPLE_SIZE))
+    per_entry = sum(deep_size(key) + deep_size(value) for key, value in sample) / len(sample)
+    return size + int(per_entry * count)
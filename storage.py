@@ -0,0 +1,638 @@
+import asyncio
+import bisect
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from sizing import estimate
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# Последний выданный номер версии сессии в таблице meta
+VERSION_KEY = 'sessions:version'
+
+
+class Session:
+    """Компактная запись сессии пользователя: известные поля лежат в слотах, а не в словаре.
+
+    Поддерживает чтение как словарь (get, [], in), поэтому обработчикам не важно, загружена ли
+    запись из хранилища или только что создана. Редкие неизвестные поля попадают в extra.
+    """
+
+    FIELDS = (
+        'name', 'category', 'platform', 'order_number', 'contact', 'email', 'birthday',
+        'stage', 'active', 'instruction_message_ids', 'order_number_request_message_id'
+    )
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, **fields):
+        self.extra = None
+        self.update(fields)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**data)
+
+    def to_dict(self) -> dict:
+        data = {}
+        for field in self.FIELDS:
+            value = getattr(self, field, _MISSING)
+            if value is not _MISSING:
+                data[field] = value
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def update(self, fields: dict):
+        for key, value in fields.items():
+            if key in self.FIELDS:
+                setattr(self, key, value)
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
+
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            return getattr(self, key, default)
+        return self.extra.get(key, default) if self.extra else default
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def pop(self, key, default=None):
+        if key in self.FIELDS:
+            value = getattr(self, key, default)
+            if hasattr(self, key):
+                delattr(self, key)
+            return value
+        return self.extra.pop(key, default) if self.extra else default
+
+    def approx_size(self) -> int:
+        """Примерный объем записи в памяти вместе со значениями полей, в байтах."""
+        size = sys.getsizeof(self)
+        for field in self.FIELDS:
+            value = getattr(self, field, None)
+            if value is not None:
+                size += sys.getsizeof(value)
+                if isinstance(value, list):
+                    size += sum(sys.getsizeof(item) for item in value)
+        if self.extra:
+            size += sys.getsizeof(self.extra) + sum(sys.getsizeof(value) for value in self.extra.values())
+        return size
+
+
+class MemoryBackend:
+    """Хранит сессии в памяти процесса. Данные теряются при перезапуске."""
+
+    def __init__(self):
+        # user_id -> (data, updated_at, version)
+        self._rows = {}
+        # (version, user_id) по возрастанию версии; записи, которые потом перезаписаны, пропускаются при чтении
+        self._log = []
+        self._version = 0
+        self._meta = {}
+        self._orders = {}
+        self._funnel = {}
+
+    def load(self, user_id):
+        row = self._rows.get(user_id)
+        return json.loads(row[0]) if row else None
+
+    def _put(self, user_id, data: str, now: float):
+        self._version += 1
+        self._rows[user_id] = (data, now, self._version)
+        self._log.append((self._version, user_id))
+
+    def write_many(self, rows):
+        now = time.time()
+        for user_id, data in rows:
+            self._put(user_id, data, now)
+        if len(self._log) > 2 * len(self._rows) + 1000:
+            self._log = sorted((row[2], user_id) for user_id, row in self._rows.items())
+
+    def deactivate(self, user_id):
+        row = self._rows.get(user_id)
+        if row:
+            data = json.loads(row[0])
+            data['active'] = False
+            self._put(user_id, json.dumps(data, ensure_ascii=False, separators=(',', ':')), time.time())
+
+    def active_user_ids_after(self, after: int, limit: int) -> list:
+        return sorted(
+            user_id for user_id, row in self._rows.items()
+            if user_id > after and json.loads(row[0]).get('active', True) is not False
+        )[:limit]
+
+    def changed_since(self, version: int, limit: int) -> list:
+        rows = []
+        index = bisect.bisect_right(self._log, (version, float('inf')))
+        while index < len(self._log) and len(rows) < limit:
+            row_version, user_id = self._log[index]
+            index += 1
+            row = self._rows.get(user_id)
+            if row is not None and row[2] == row_version:
+                rows.append((user_id, row[0], row[1], row_version))
+        return rows
+
+    def get_meta(self, key: str):
+        return self._meta.get(key)
+
+    def put_meta(self, key: str, value: str):
+        self._meta[key] = value
+
+    def load_orders(self) -> list:
+        return [(platform, order_number, user_id) for (platform, order_number), user_id in self._orders.items()]
+
+    def write_orders(self, rows):
+        for platform, order_number, user_id, release in rows:
+            if release:
+                for key in [key for key, owner in self._orders.items()
+                            if owner == user_id and key != (platform, order_number)]:
+                    del self._orders[key]
+        for platform, order_number, user_id, _ in rows:
+            self._orders.setdefault((platform, order_number), user_id)
+
+    def claim_order(self, platform: str, order_number: str, user_id: int) -> int:
+        return self._orders.setdefault((platform, order_number), user_id)
+
+    def add_funnel(self, rows):
+        for *key, count in rows:
+            key = tuple(key)
+            self._funnel[key] = self._funnel.get(key, 0) + count
+
+    def funnel_counts(self, since_bucket: int) -> list:
+        totals = {}
+        for (bucket, *key), count in self._funnel.items():
+            if bucket >= since_bucket:
+                totals[tuple(key)] = totals.get(tuple(key), 0) + count
+        return [key + (count,) for key, count in totals.items()]
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """Хранит сессии в SQLite в режиме WAL, чтобы файл можно было читать из нескольких процессов.
+
+    load() вызывается из цикла событий при промахе кеша, поэтому читает через отдельное
+    соединение только для чтения: в WAL чтение не ждет ни записи в потоке сброса, ни блокировки
+    файла другими процессами.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL, version INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_version ON sessions (version)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS orders ("
+            "platform TEXT NOT NULL, order_number TEXT NOT NULL, user_id INTEGER NOT NULL, "
+            "PRIMARY KEY (platform, order_number))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS orders_user_id ON orders (user_id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS funnel ("
+            "bucket INTEGER NOT NULL, source TEXT NOT NULL, target TEXT NOT NULL, platform TEXT NOT NULL, "
+            "category TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (bucket, source, target, platform, category))"
+        )
+        self._conn.commit()
+        self._read_lock = threading.Lock()
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+        self._reader.execute("PRAGMA query_only=ON")
+
+    def _set_version(self, version: int):
+        self._conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (VERSION_KEY, str(version))
+        )
+
+    def _next_versions(self, count: int) -> int:
+        """Резервирует count номеров версии и возвращает первый.
+
+        Вызывается в транзакции BEGIN IMMEDIATE: записи всех процессов идут по очереди, поэтому
+        запись, зафиксированная позже, всегда получает больший номер. По времени изменения
+        так сравнивать нельзя: часы процессов расходятся, а транзакция может зафиксироваться
+        позже, чем взято время.
+        """
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (VERSION_KEY,)).fetchone()
+        first = int(row[0]) + 1 if row else 1
+        self._set_version(first + count - 1)
+        return first
+
+    def load(self, user_id):
+        with self._read_lock:
+            row = self._reader.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write_many(self, rows):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            first = self._next_versions(len(rows))
+            self._conn.executemany(
+                "INSERT INTO sessions (user_id, data, updated_at, version) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                "data = excluded.data, updated_at = excluded.updated_at, version = excluded.version",
+                [(user_id, data, now, first + i) for i, (user_id, data) in enumerate(rows)]
+            )
+
+    def deactivate(self, user_id):
+        """Помечает пользователя неактивным в записанной сессии, не трогая остальные поля."""
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute(
+                "UPDATE sessions SET data = json_set(data, '$.active', json('false')), updated_at = ?, version = ? "
+                "WHERE user_id = ?",
+                (time.time(), self._next_versions(1), user_id)
+            )
+
+    def active_user_ids_after(self, after: int, limit: int) -> list:
+        """user_id после after, кроме пользователей, заблокировавших бота (active = false)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id FROM sessions WHERE user_id > ? AND json_extract(data, '$.active') IS NOT 0 "
+                "ORDER BY user_id LIMIT ?", (after, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def changed_since(self, version: int, limit: int) -> list:
+        """Записи с версией больше version по возрастанию версии: (user_id, data, updated_at, version)."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT user_id, data, updated_at, version FROM sessions WHERE version > ? ORDER BY version LIMIT ?",
+                (version, limit)
+            ).fetchall()
+
+    def get_meta(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put_meta(self, key: str, value: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+
+    def load_orders(self) -> list:
+        with self._lock:
+            return self._conn.execute("SELECT platform, order_number, user_id FROM orders").fetchall()
+
+    def write_orders(self, rows):
+        """Закрепляет номера (platform, order_number, user_id, release) в одной транзакции.
+
+        У пользователя с release освобождаются остальные номера. Сначала идут все освобождения:
+        номер, который один пользователь освободил, а другой занял в той же пачке, достается второму.
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM orders WHERE user_id = ? AND NOT (platform = ? AND order_number = ?)",
+                [(user_id, platform, order_number) for platform, order_number, user_id, release in rows if release]
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO orders (platform, order_number, user_id) VALUES (?, ?, ?)",
+                [(platform, order_number, user_id) for platform, order_number, user_id, _ in rows]
+            )
+
+    def claim_order(self, platform: str, order_number: str, user_id: int) -> int:
+        """Записывает номер за пользователем, если он свободен, и возвращает владельца номера."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO orders (platform, order_number, user_id) VALUES (?, ?, ?)",
+                (platform, order_number, user_id)
+            )
+            return self._conn.execute(
+                "SELECT user_id FROM orders WHERE platform = ? AND order_number = ?", (platform, order_number)
+            ).fetchone()[0]
+
+    def add_funnel(self, rows):
+        """Прибавляет счетчики воронки; процессы могут писать одни и те же ячейки одновременно."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO funnel (bucket, source, target, platform, category, count) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(bucket, source, target, platform, category) DO UPDATE SET count = count + excluded.count",
+                rows
+            )
+
+    def funnel_counts(self, since_bucket: int) -> list:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT source, target, platform, category, SUM(count) FROM funnel WHERE bucket >= ? "
+                "GROUP BY source, target, platform, category", (since_bucket,)
+            ).fetchall()
+
+    def close(self):
+        with self._read_lock:
+            self._reader.close()
+        with self._lock:
+            self._conn.close()
+
+
+class SessionStore:
+    """Данные анкеты пользователей с горячим кешем в памяти и отложенной пакетной записью в хранилище.
+
+    Записи, возвращаемые get(), нельзя изменять напрямую: все изменения проходят через
+    create(), update() и pop(), чтобы попасть в очередь на запись.
+
+    Кеш ограничен: после каждой записи из него выгружаются сессии, к которым не обращались
+    дольше ttl секунд, а затем самые давно использованные, пока примерный объем кеша не станет
+    меньше memory_budget байт. Выгружаются только уже записанные сессии, и при следующем
+    апдейте пользователя они снова читаются из хранилища.
+
+    При промахе кеша get() читает хранилище синхронно, поэтому сессию автора апдейта заранее
+    загружает load() в потоке (см. update_processor.py), и обработчики получают ее из кеша.
+    Если сессии в хранилище нет, это тоже запоминается до create() или выгрузки по TTL,
+    чтобы get() нового пользователя не шел в хранилище из цикла событий.
+    """
+
+    def __init__(self, backend=None, flush_interval: float = 1.0, batch_size: int = 500,
+                 ttl: float = 3600.0, memory_budget: int = 64 * 1024 * 1024):
+        self._backend = backend or MemoryBackend()
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self.memory_budget = memory_budget
+        self._cache = {}
+        # user_id -> время последнего обращения, в порядке от давних к недавним
+        self._access = OrderedDict()
+        self._sizes = {}
+        self._resident = 0
+        self._dirty = set()
+        # user_id, для которых load() не нашел сессии в хранилище; выгружаются из кеша вместе с сессиями
+        self._absent = set()
+        # Сессии, запись которых сейчас идет в потоке: их нельзя выгружать, иначе get() прочитает старую версию
+        self._writing = set()
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = None
+        self._flush_task = None
+        self._flush_hooks = []
+        self._evict_hooks = []
+
+    def configure(self, backend, flush_interval: float = None, batch_size: int = None,
+                  ttl: float = None, memory_budget: int = None):
+        self._backend = backend
+        self._cache.clear()
+        self._absent.clear()
+        self._access.clear()
+        self._sizes.clear()
+        self._resident = 0
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if ttl is not None:
+            self.ttl = ttl
+        if memory_budget is not None:
+            self.memory_budget = memory_budget
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def resident_bytes(self) -> int:
+        return self._resident
+
+    def memory_usage(self) -> list:
+        return [
+            ('sessions', len(self._cache), self._resident),
+            ('sessions LRU', len(self._access),
+             sys.getsizeof(self._access) + estimate(self._sizes) + sys.getsizeof(self._absent)),
+        ]
+
+    def cached(self) -> list:
+        """Записи, которые сейчас в памяти, без обращения к хранилищу и без обновления LRU."""
+        return list(self._cache.values())
+
+    def __contains__(self, user_id) -> bool:
+        return self.get(user_id) is not None
+
+    def _touch(self, user_id):
+        self._access[user_id] = time.monotonic()
+        self._access.move_to_end(user_id)
+
+    def get(self, user_id):
+        data = self._cache.get(user_id)
+        if data is None and user_id not in self._absent:
+            row = self._backend.load(user_id)
+            if row is not None:
+                data = self._cache[user_id] = Session.from_dict(row)
+                self._resize(user_id, data)
+        if data is not None or user_id in self._absent:
+            self._touch(user_id)
+        return data
+
+    async def load(self, user_id):
+        """get(), который при промахе кеша читает хранилище в отдельном потоке, не блокируя цикл событий."""
+        if user_id in self._cache or user_id in self._absent:
+            return self.get(user_id)
+        row = await asyncio.to_thread(self._backend.load, user_id)
+        # Пока шло чтение, сессию могли создать в цикле событий, и тогда прочитанное устарело
+        if user_id in self._cache or user_id in self._absent:
+            return self.get(user_id)
+        if row is None:
+            self._absent.add(user_id)
+        else:
+            self._cache[user_id] = Session.from_dict(row)
+            self._resize(user_id, self._cache[user_id])
+        return self.get(user_id)
+
+    def create(self, user_id, **fields) -> Session:
+        data = self._cache[user_id] = Session(**fields)
+        self._absent.discard(user_id)
+        self._touch(user_id)
+        self._mark_dirty(user_id)
+        return data
+
+    def update(self, user_id, **fields) -> Session:
+        data = self.get(user_id)
+        if data is None:
+            return self.create(user_id, **fields)
+        data.update(fields)
+        self._mark_dirty(user_id)
+        return data
+
+    def pop(self, user_id, key, default=None):
+        data = self.get(user_id)
+        if data is None or key not in data:
+            return default
+        value = data.pop(key)
+        self._mark_dirty(user_id)
+        return value
+
+    def add_flush_hook(self, hook):
+        """Регистрирует корутину, которая вызывается при каждой записи сессий, например для связанных индексов."""
+        self._flush_hooks.append(hook)
+
+    def add_evict_hook(self, hook):
+        """Регистрирует функцию hook(user_id), которая вызывается для каждой выгруженной из кеша сессии."""
+        self._evict_hooks.append(hook)
+
+    def _resize(self, user_id, data: Session):
+        size = data.approx_size()
+        self._resident += size - self._sizes.get(user_id, 0)
+        self._sizes[user_id] = size
+
+    def _drop(self, user_id):
+        self._cache.pop(user_id, None)
+        self._absent.discard(user_id)
+        self._access.pop(user_id, None)
+        self._resident -= self._sizes.pop(user_id, 0)
+
+    def evict(self) -> int:
+        """Выгружает из кеша записанные сессии по TTL и бюджету памяти. Возвращает число выгруженных."""
+        cutoff = time.monotonic() - self.ttl
+        evicted = 0
+        skipped = []
+        while self._access:
+            user_id, last_access = next(iter(self._access.items()))
+            if last_access >= cutoff and self._resident <= self.memory_budget:
+                break
+            if user_id in self._dirty or user_id in self._writing:
+                # Несохраненные изменения выгружаются после следующей записи
+                skipped.append((user_id, self._access.pop(user_id)))
+                continue
+            self._drop(user_id)
+            for hook in self._evict_hooks:
+                hook(user_id)
+            evicted += 1
+        for user_id, last_access in reversed(skipped):
+            self._access[user_id] = last_access
+            self._access.move_to_end(user_id, last=False)
+        if evicted:
+            logger.debug("Evicted %s sessions, %s resident, ~%s bytes", evicted, len(self._cache), self._resident)
+        return evicted
+
+    def _mark_dirty(self, user_id):
+        self._dirty.add(user_id)
+        if len(self._dirty) >= self.batch_size:
+            self._wake()
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self):
+        # Сброс вызывают цикл записи, /export и рассылка; без блокировки более старый пакет
+        # мог бы зафиксироваться после более нового и перезаписать его
+        async with self._flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        for hook in self._flush_hooks:
+            try:
+                await hook()
+            except Exception as e:
+                logger.error("Flush hook %s failed: %s", getattr(hook, '__qualname__', hook), e)
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        # Сериализация выполняется в цикле событий, чтобы поток записи не видел словари в процессе изменения
+        rows = []
+        for user_id in dirty:
+            data = self._cache.get(user_id)
+            if data is not None:
+                rows.append((user_id, json.dumps(data.to_dict(), ensure_ascii=False, separators=(',', ':'))))
+                self._resize(user_id, data)
+        self._writing = dirty
+        try:
+            await asyncio.to_thread(self._backend.write_many, rows)
+        except Exception as e:
+            logger.error("Could not flush %s sessions: %s", len(rows), e)
+            self._dirty |= dirty
+        finally:
+            self._writing = set()
+
+    async def deactivate(self, user_id):
+        """Помечает пользователя неактивным сразу в хранилище.
+
+        Сессию может держать в кеше процесс, которому принадлежит пользователь; через update()
+        другого процесса флаг затерся бы его следующей записью. Запись в хранилище меняет только
+        поле active, а в кеше этого процесса флаг обновляется без постановки в очередь на запись.
+        """
+        await asyncio.to_thread(self._backend.deactivate, user_id)
+        data = self._cache.get(user_id)
+        if data is not None:
+            data.update({'active': False})
+
+    async def iter_user_ids(self, after: int = 0, batch_size: int = 500):
+        """Перебирает user_id активных пользователей по возрастанию, читая хранилище пачками.
+
+        Сессии не загружаются ни в память, ни в кеш: рассылка по всей базе не вытесняет
+        из кеша пользователей, которые сейчас отвечают на вопросы.
+        """
+        await self.flush()
+        while True:
+            batch = await asyncio.to_thread(self._backend.active_user_ids_after, after, batch_size)
+            if not batch:
+                return
+            for user_id in batch:
+                yield user_id
+            after = batch[-1]
+
+    async def get_meta(self, key: str):
+        value = await asyncio.to_thread(self._backend.get_meta, key)
+        return json.loads(value) if value is not None else None
+
+    async def put_meta(self, key: str, value):
+        await asyncio.to_thread(self._backend.put_meta, key, json.dumps(value, ensure_ascii=False))
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            self.evict()
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        self._backend.close()
+
+    @property
+    def backend(self):
+        return self._backend
+
+
+def create_backend(kind: str, path: str):
+    if kind == 'sqlite':
+        return SQLiteBackend(path)
+    if kind == 'memory':
+        return MemoryBackend()
+    raise ValueError(f"Unknown session backend: {kind}")
+
+
+sessions = SessionStore()
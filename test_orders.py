@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from orders import OrderIndex
+from storage import MemoryBackend, SQLiteBackend, SessionStore
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    backend = MemoryBackend() if request.param == 'memory' else SQLiteBackend(str(tmp_path / 'sessions.db'))
+    yield SessionStore(backend)
+    backend.close()
+
+
+def stored(store) -> set:
+    return set(store.backend.load_orders())
+
+
+def test_reclaim_in_one_batch_keeps_the_last_order(store):
+    async def scenario():
+        index = OrderIndex()
+        await index.load(store)
+        assert await index.claim('Ozon', '12345678-0001', 1)
+        assert await index.claim('Ozon', '12345678-0002', 1)
+        assert await index.claim('Ozon', '12345678-0001', 1)
+        await index.flush()
+
+    asyncio.run(scenario())
+    assert stored(store) == {('Ozon', '12345678-0001', 1)}
+
+
+def test_order_released_and_claimed_by_another_user_in_one_batch(store):
+    async def scenario():
+        index = OrderIndex()
+        await index.load(store)
+        assert await index.claim('Ozon', '12345678-0001', 1)
+        await index.flush()
+        assert await index.claim('Ozon', '12345678-0002', 1)
+        assert await index.claim('Ozon', '12345678-0001', 2)
+        await index.flush()
+
+    asyncio.run(scenario())
+    assert stored(store) == {('Ozon', '12345678-0002', 1), ('Ozon', '12345678-0001', 2)}
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+from telegram.ext import BaseUpdateProcessor
+
+from logging_setup import log_update_id, log_user_id
+from storage import sessions
+
+logger = logging.getLogger(__name__)
+
+
+def update_key(update):
+    """Ключ упорядочивания: пользователь, а если его нет - чат."""
+    user = getattr(update, 'effective_user', None)
+    if user:
+        return user.id
+    chat = getattr(update, 'effective_chat', None)
+    if chat:
+        return chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает апдейты разных пользователей параллельно, а апдейты одного пользователя - строго по очереди.
+
+    Блокировка пользователя берется до общего семафора, поэтому очередь одного пользователя
+    не занимает слоты, нужные остальным.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}
+
+    async def process_update(self, update, coroutine) -> None:
+        key = update_key(update)
+        log_user_id.set(key)
+        log_update_id.set(getattr(update, 'update_id', None))
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        # Сессия читается с диска здесь, в потоке, а не синхронно в первом sessions.get() обработчика
+        user = getattr(update, 'effective_user', None)
+        if user:
+            try:
+                await sessions.load(user.id)
+            except Exception as e:
+                # Обработчик все равно получит сессию: get() прочитает ее сам
+                logger.error("Could not preload session of user %s: %s", user.id, e)
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -3,24 +3,75 @@ import asyncio
 import logging
 from telegram.ext import CallbackContext
 from telegram import Update
+from telegram.error import BadRequest, TelegramError
+from outbox import outbox
 
 logger = logging.getLogger(__name__)
 def is_cyrillic(text):
     return bool(re.match(r'^[А-Яа-яЁё]+$', text))
 
+EMAIL_PATTERN = re.compile(r"[^@]+@[^@]+\.[^@]+")
+
+def is_valid_email(text):
+    return text.lower() == 'пропустить' or EMAIL_PATTERN.match(text) is not None
+
+def is_valid_birthday(text):
+    try:
+        day, month, year = map(int, text.split('.'))
+    except ValueError:
+        return False
+    return 1 <= day <= 31 and 1 <= month <= 12 and 1900 <= year <= 2100
+
 async def send_messages(message, context, messages_list, parse_mode=None):
+    """Ставит сообщения в очередь чата с паузой между ними и сразу возвращает управление."""
     for msg in messages_list:
-        await message.reply_text(msg, parse_mode=parse_mode)
-        await asyncio.sleep(2)
+        outbox.submit(message.chat_id, 'send_message', paced=True, text=msg, parse_mode=parse_mode)
 
-async def clear_message_cache(context: CallbackContext, query: Update, message_ids: list):
-    """Удаляет сообщения, указанные в списке message_ids."""
-    chat_id = query.message.chat_id
+DELETE_BATCH_SIZE = 100
+DELETE_CONCURRENCY = 8
+
+def is_message_gone(error: Exception) -> bool:
+    return isinstance(error, BadRequest) and 'message to delete not found' in error.message.lower()
+
+async def delete_messages(bot, chat_id: int, message_ids: list, concurrency: int = DELETE_CONCURRENCY):
+    """Удаляет сообщения пачками через deleteMessages, а при его недоступности - параллельно по одному.
 
-    for message_id in message_ids:
+    Уже удаленные сообщения считаются успешно удаленными.
+    """
+    message_ids = [message_id for message_id in message_ids if message_id]
+    if not message_ids:
+        return
+
+    leftover = []
+    for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        batch = message_ids[i:i + DELETE_BATCH_SIZE]
+        if not hasattr(bot, 'delete_messages'):
+            leftover.extend(batch)
+            continue
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        except Exception as e:
-            logger.warning(f"Could not delete message {message_id}: {e}")
+            await bot.delete_messages(chat_id=chat_id, message_ids=batch)
+        except TelegramError as e:
+            logger.debug("Bulk delete failed in chat %s, falling back to single deletes: %s", chat_id, e)
+            leftover.extend(batch)
+
+    if not leftover:
+        return
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def delete_one(message_id):
+        async with semaphore:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message_id)
+            except Exception as e:
+                if not is_message_gone(e):
+                    return message_id, e
+        return None
 
-    return
\ No newline at end of file
+    failed = [result for result in await asyncio.gather(*(delete_one(message_id) for message_id in leftover)) if result]
+    if failed:
+        logger.warning("Could not delete %s messages in chat %s, first error: %s", len(failed), chat_id, failed[0][1])
+
+async def clear_message_cache(context: CallbackContext, query: Update, message_ids: list):
+    """Удаляет сообщения, указанные в списке message_ids."""
+    await delete_messages(context.bot, query.message.chat_id, message_ids)